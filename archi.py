@@ -1,10 +1,24 @@
+import mmap
+import threading
+from collections import OrderedDict
+from functools import partial
+
+OPERAND_OPCODES = frozenset((0x01, 0x02, 0x03, 0x04, 0x05, 0x06))
+
+# Every IDLE_CHECK_INTERVAL cycles the CPU single-steps up to IDLE_WINDOW
+# instructions looking for a loop that comes back to the same state
+# without storing anything, which can only ever repeat itself.
+IDLE_CHECK_INTERVAL = 1 << 20
+IDLE_WINDOW = 2048
+
+
 class CPU:
     def __init__(self):
         self.A = 0
         self.B = 0
         self.PC = 0
 
-        self.memory = [0] * 1024 # 1KB memory
+        self.memory = bytearray(1024) # 1KB memory, one byte per cell
 
         self.zero_flag = False
         self.carry_flag = False
@@ -21,11 +35,64 @@ class CPU:
         }
         
         self.running = False
+        self.cycles = 0
+        self.halt_reason = None  # 'halt', 'unknown-instruction', 'cycle-limit' or 'infinite-loop'
+        self._since_check = 0    # cycles since the last idle-loop check
+        self._loop_period = None # length of the endless loop resume last stopped in
 
     def load_program(self, program):
-        """Load a program into memory"""
-        for i, value in enumerate(program):
-            self.memory[i] = value
+        """Load a program into memory.
+
+        Bytes-like programs are copied in a single slice; sequences of ints
+        are wrapped to 8 bits first.
+        """
+        if isinstance(program, (bytes, bytearray, memoryview, mmap.mmap)):
+            data = program
+        else:
+            data = bytes(value & 0xFF for value in program)
+        if len(data) > len(self.memory):
+            raise IndexError("Program does not fit in memory")
+        self.memory[:len(data)] = data
+
+    def save_image(self, path):
+        """Write memory to a raw image file"""
+        with open(path, 'wb') as f:
+            f.write(self.memory)
+
+    def load_image(self, path, offset=0):
+        """Read a raw memory image, starting offset bytes into the file, straight into memory"""
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            f.readinto(memoryview(self.memory))
+        self.invalidate()
+
+    def map_image(self, path, offset=0):
+        """Use a private copy-on-write mapping of a raw image file as memory.
+
+        Nothing is read up front and writes never reach the file. offset
+        must be a multiple of mmap.ALLOCATIONGRANULARITY.
+        """
+        with open(path, 'rb') as f:
+            self.memory = mmap.mmap(f.fileno(), len(self.memory),
+                                    access=mmap.ACCESS_COPY, offset=offset)
+        self.invalidate()
+
+    def invalidate(self, start=0, end=None):
+        """Note that memory[start:end] changed behind the CPU's back (no-op here)"""
+
+    def reset(self):
+        """Return to power-on state: registers, flags and memory cleared"""
+        self.A = 0
+        self.B = 0
+        self.PC = 0
+        self.memory[:] = bytes(len(self.memory))
+        self.zero_flag = False
+        self.carry_flag = False
+        self.running = False
+        self.cycles = 0
+        self.halt_reason = None
+        self._since_check = 0
+        self._loop_period = None
 
     def fetch(self):
         """Fetch an instruction from memory"""
@@ -95,16 +162,576 @@ class CPU:
         """Halt the CPU"""
         self.running = False
 
-    def run(self):
-        """Run the CPU"""
-        self.running = True
+    def run(self, max_cycles=None, profiler=None):
+        """Run the CPU from address 0, returning the number of cycles executed.
+
+        With a profiler, runs through its instrumented loop instead.
+        """
+        if profiler is not None:
+            return profiler.run_cpu(self, max_cycles)
+
         self.PC = 0
-        
+        self.cycles = 0
+        return self.resume(max_cycles)
+
+    def resume(self, max_cycles=None):
+        """Continue from the current PC for at most max_cycles instructions.
+
+        Sets halt_reason once the CPU stops. A loop that returns to the
+        same PC, A and flags with no STA in between can never leave, so
+        it ends the run as 'infinite-loop': at once without a budget,
+        otherwise fast-forwarded to the exact state the budget would
+        have reached.
+        """
+        if max_cycles is not None and max_cycles < 0:
+            raise ValueError(f"max_cycles must be non-negative, got {max_cycles}")
+        self.running = True
+        self.halt_reason = None
+        executed = 0
         while self.running:
-            instruction = self.fetch()
-            self.execute(instruction)
-            
+            left = None if max_cycles is None else max_cycles - executed
+            if left == 0:
+                self.halt_reason = 'cycle-limit'
+                break
+            chunk = IDLE_CHECK_INTERVAL - self._since_check
+            n = self._run_fast(chunk if left is None else min(chunk, left))
+            executed += n
+            self._since_check += n
+            if not self.running or self._since_check < IDLE_CHECK_INTERVAL:
+                continue
+
+            self._since_check = 0
+            window = IDLE_WINDOW if left is None else min(IDLE_WINDOW, left - n)
+            steps, period = self._find_loop(window)
+            executed += steps
+            if period is not None:
+                executed += self._skip_loop(period, None if left is None else left - n - steps)
+
+        if self.halt_reason is None:
+            self.halt_reason = 'halt' if self.memory[self.PC - 1] == 0xFF else 'unknown-instruction'
+        return executed
+
+    def step(self):
+        """Execute a single instruction"""
+        self.execute(self.fetch())
+        self.cycles += 1
+
+    def _run_fast(self, cycles):
+        """Execute up to cycles instructions, stopping early if the CPU halts"""
+        executed = 0
+        while self.running and executed < cycles:
+            self.execute(self.fetch())
+            executed += 1
+        self.cycles += executed
+        return executed
+
+    def _find_loop(self, limit):
+        """Single-step up to limit instructions looking for a loop with no side effects.
+
+        Returns (instructions executed, loop period in cycles or None).
+        """
+        memory = self.memory
+        seen = {}
+        for steps in range(1, limit + 1):
+            pc = self.PC
+            opcode = memory[pc]
+            self.step()
+            if not self.running:
+                return steps, None
+            if opcode == 0x04:
+                seen.clear()
+            elif opcode in (0x05, 0x06) and self.PC <= pc:
+                key = (self.PC, self.A, self.zero_flag, self.carry_flag)
+                if key in seen:
+                    return steps, steps - seen[key]
+                seen[key] = steps
+        return limit, None
+
+    def skip_loop(self, cycles):
+        """Advance the endless loop resume stopped in by cycles more instructions.
+
+        Leaves the CPU in the state the next cycles of the loop would reach,
+        as if resume had been given them too; returns cycles.
+        """
+        if self.halt_reason != 'infinite-loop':
+            raise ValueError(f"CPU is not stopped in an endless loop ({self.halt_reason})")
+        if cycles < 0:
+            raise ValueError(f"cycles must be non-negative, got {cycles}")
+        return self._skip_loop(self._loop_period, cycles)
+
+    def _skip_loop(self, period, remaining):
+        """Stop in an endless loop, first advancing remaining cycles when given"""
+        self.halt_reason = 'infinite-loop'
+        self._loop_period = period
+        self.running = False
+        if remaining is None:
+            return 0
+        skipped = remaining // period * period
+        self.cycles += skipped
+        for _ in range(remaining - skipped):
+            self.step()
+        self.running = False
+        return remaining
+
     def dump_state(self):
         """Print CPU state for debugging"""
         print(f"A: {hex(self.A)}, B: {hex(self.B)}, PC: {hex(self.PC)}")
-        print(f"Flags - Zero: {self.zero_flag}, Carry: {self.carry_flag}")
\ No newline at end of file
+        print(f"Flags - Zero: {self.zero_flag}, Carry: {self.carry_flag}")
+
+
+class DecodedCPU(CPU):
+    """CPU that decodes memory once into a table of pre-bound operations.
+
+    Each table entry is a closure with its operand already resolved that
+    executes one instruction and returns the next PC (or ~PC once the CPU
+    halts). Addresses that have not been decoded yet hold a trap that decodes
+    on first use; entries fall back to a trap again when ``sta`` writes over
+    the bytes they were decoded from. LDA/ADD/SUB operands that are STA
+    targets (a counter kept in its own LDA, say) are read from memory when
+    the instruction runs instead, so rewriting them costs nothing.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.cycles = 0
+        self._state = [0, False, False]  # A, zero flag, carry flag
+        self.invalidate()
+
+    def load_program(self, program):
+        """Load a program into memory, note its STA targets and decode it"""
+        super().load_program(program)
+        self.invalidate()
+        memory = self.memory
+        pc = 0
+        end = min(len(program), len(memory) - 1)
+        while pc < end:
+            if memory[pc] == 0x04:
+                self._stores[memory[pc + 1]] = 1
+            pc = pc + 2 if memory[pc] in OPERAND_OPCODES else pc + 1
+        pc = 0
+        while pc < end:
+            pc = self._span_end(pc)
+
+    def reset(self):
+        """Return to power-on state and forget all decoded operations"""
+        super().reset()
+        self.cycles = 0
+        self.invalidate()
+
+    def invalidate(self, start=0, end=None):
+        """Drop decoded operations overlapping memory[start:end]"""
+        size = len(self.memory)
+        if end is None:
+            end = size
+        if start == 0 and end >= size:
+            self._traps = [partial(self._trap, address) for address in range(size)]
+            self.code = self._traps[:]
+            self._covered = bytearray(size)  # bytes some decoded operation depends on
+            self._stores = bytearray(size)   # bytes known to be written at run time
+            return
+        end = min(end, size)
+        # Every operation reading these bytes starts in [start - 1, end) and
+        # is dropped here; from now on they count as written at run time
+        self._covered[start:end] = bytes(end - start)
+        self._stores[start:end] = b"\x01" * (end - start)
+        start = max(start - 1, 0)
+        self.code[start:end] = self._traps[start:end]
+
+    def _trap(self, pc):
+        """Placeholder operation: decode the instruction at pc, then run it"""
+        return self.decode(pc)()
+
+    def _span_end(self, pc):
+        """Decode the instruction at pc and return the address following it"""
+        self.decode(pc)
+        return pc + 2 if self.memory[pc] in OPERAND_OPCODES else pc + 1
+
+    def decode(self, pc):
+        """Build and cache the operation for the instruction at pc"""
+        memory = self.memory
+        state = self._state
+        covered = self._covered
+        code = self.code
+        opcode = memory[pc]
+        nxt = pc + 1
+        dynamic = opcode in (0x01, 0x02, 0x03) and self._stores[nxt]
+
+        if dynamic:
+            operand = nxt
+            nxt += 1
+            if opcode == 0x01:
+                def op():
+                    value = memory[operand]
+                    state[0] = value
+                    state[1] = value == 0
+                    return nxt
+            elif opcode == 0x02:
+                def op():
+                    result = state[0] + memory[operand]
+                    state[2] = result > 255
+                    result &= 0xFF
+                    state[0] = result
+                    state[1] = result == 0
+                    return nxt
+            else:
+                def op():
+                    result = state[0] - memory[operand]
+                    state[2] = result < 0
+                    result &= 0xFF
+                    state[0] = result
+                    state[1] = result == 0
+                    return nxt
+        elif opcode == 0x01:
+            value = memory[nxt]
+            nxt += 1
+            zero = value == 0
+
+            def op():
+                state[0] = value
+                state[1] = zero
+                return nxt
+        elif opcode == 0x02:
+            value = memory[nxt]
+            nxt += 1
+
+            def op():
+                result = state[0] + value
+                state[2] = result > 255
+                result &= 0xFF
+                state[0] = result
+                state[1] = result == 0
+                return nxt
+        elif opcode == 0x03:
+            value = memory[nxt]
+            nxt += 1
+
+            def op():
+                result = state[0] - value
+                state[2] = result < 0
+                result &= 0xFF
+                state[0] = result
+                state[1] = result == 0
+                return nxt
+        elif opcode == 0x04:
+            address = memory[nxt]
+            nxt += 1
+
+            def op():
+                memory[address] = state[0]
+                if covered[address]:
+                    self.invalidate(address, address + 1)
+                return nxt
+        elif opcode == 0x05:
+            address = memory[nxt]
+
+            def op():
+                return address
+        elif opcode == 0x06:
+            address = memory[nxt]
+            nxt += 1
+
+            def op():
+                return address if state[1] else nxt
+        elif opcode == 0x00:
+            def op():
+                return nxt
+        elif opcode == 0xFF:
+            def op():
+                return ~nxt
+        else:
+            def op():
+                # Unknown opcodes go through the reference path so the
+                # diagnostics match CPU.execute exactly.
+                self._sync_out(nxt)
+                self.execute(opcode)
+                return ~nxt
+
+        covered[pc] = 1
+        if opcode in OPERAND_OPCODES and not dynamic:
+            covered[pc + 1] = 1
+        code[pc] = op
+        return op
+
+    def _sync_out(self, pc):
+        self.A, self.zero_flag, self.carry_flag = self._state
+        self.PC = pc
+
+    def run(self, max_cycles=None, profiler=None):
+        """Run the CPU from address 0, returning the number of cycles executed"""
+        if profiler is not None:
+            return profiler.run_cpu(self, max_cycles)
+
+        self.PC = 0
+        self.cycles = 0
+        return self.resume(max_cycles)
+
+    def step(self):
+        """Execute a single instruction through its decoded operation"""
+        self._state[:] = [self.A, self.zero_flag, self.carry_flag]
+        pc = self.code[self.PC]()
+        if pc < 0:
+            pc = ~pc
+            self.running = False
+        self._sync_out(pc)
+        self.cycles += 1
+
+    def _run_fast(self, cycles):
+        """Execute up to cycles instructions, stopping early if the CPU halts"""
+        self._state[:] = [self.A, self.zero_flag, self.carry_flag]
+        code = self.code
+        pc = self.PC
+        executed = 0
+
+        while pc >= 0 and executed < cycles:
+            pc = code[pc]()
+            executed += 1
+
+        if pc < 0:
+            pc = ~pc
+            self.running = False
+        self._sync_out(pc)
+        self.cycles += executed
+        return executed
+
+
+MAX_BLOCK_LENGTH = 64     # instructions per compiled block
+BLOCK_CACHE_SIZE = 4096   # compiled blocks kept, shared by every JITCPU
+
+# (start address, block bytes) -> factory binding a compiled block to a CPU.
+# Shared by every JITCPU, so identical code is only compiled once while it
+# stays cached; least recently used blocks are dropped first.
+_BLOCK_CACHE = OrderedDict()
+_BLOCK_CACHE_LOCK = threading.Lock()
+
+
+class JITCPU(DecodedCPU):
+    """CPU that compiles basic blocks of the program into Python functions.
+
+    A block runs from its entry address up to the next JMP, HALT, unknown
+    opcode or known jump target; JZ leaves through a side exit. A and the
+    flags live in locals, and a block whose JMP returns to its own entry is
+    compiled as a while loop. Anything a block cannot express falls back to
+    the single-step DecodedCPU operations, and blocks are dropped when
+    ``sta`` writes over their bytes, except for operands that are known STA
+    targets: those are read from memory inside the block.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._targets = set()
+
+    def reset(self):
+        """Return to power-on state and forget all compiled blocks"""
+        super().reset()
+        self._targets = set()
+
+    def load_program(self, program):
+        """Load a program, decode it and record its jump targets"""
+        super().load_program(program)
+        self._targets = set()
+        pc = 0
+        end = min(len(program), len(self.memory) - 1)
+        while pc < end:
+            if self.memory[pc] in (0x05, 0x06):
+                self._targets.add(self.memory[pc + 1])
+            pc = pc + 2 if self.memory[pc] in OPERAND_OPCODES else pc + 1
+
+    def invalidate(self, start=0, end=None):
+        """Drop decoded operations and compiled blocks overlapping memory[start:end]"""
+        super().invalidate(start, end)
+        size = len(self.memory)
+        if end is None:
+            end = size
+        if start == 0 and end >= size:
+            self.blocks = [None] * size
+            self._spans = {}
+            return
+        for block_start, block_end in list(self._spans.items()):
+            if block_start < end and start < block_end:
+                self.blocks[block_start] = None
+                del self._spans[block_start]
+
+    def _scan_block(self, start):
+        """Return the (pc, opcode, operand) list of the block starting at start"""
+        memory = self.memory
+        size = len(memory)
+        ops = []
+        pc = start
+        while len(ops) < MAX_BLOCK_LENGTH and pc < size:
+            opcode = memory[pc]
+            if opcode not in self.instructions:
+                break
+            operand = None
+            if opcode in OPERAND_OPCODES:
+                if pc + 1 >= size:
+                    break
+                operand = memory[pc + 1]
+                if opcode == 0x04 and operand >= size:
+                    break
+            ops.append((pc, opcode, operand))
+            if opcode in (0x05, 0xFF):
+                break
+            pc += 2 if operand is not None else 1
+
+        self._targets.update(operand for _, opcode, operand in ops if opcode in (0x05, 0x06))
+        for _, opcode, operand in ops:
+            if opcode == 0x04:
+                self._stores[operand] = 1
+        for i, (pc, _, _) in enumerate(ops):
+            if i and pc in self._targets:
+                return ops[:i]
+        return ops
+
+    def compile_block(self, start):
+        """Compile (or fetch from the cache) the block at start and install it"""
+        ops = self._scan_block(start)
+        if not ops:
+            self.blocks[start] = False
+            self._spans[start] = start + 1
+            return False
+
+        last_pc, last_opcode, _ = ops[-1]
+        end = last_pc + (2 if last_opcode in OPERAND_OPCODES else 1)
+        dynamic = tuple(pc + 1 for pc, opcode, _ in ops
+                        if opcode in (0x01, 0x02, 0x03) and self._stores[pc + 1])
+        code = bytearray(self.memory[start:end])
+        for address in dynamic:
+            code[address - start] = 0
+        key = (start, bytes(code), dynamic)
+        with _BLOCK_CACHE_LOCK:
+            make = _BLOCK_CACHE.get(key)
+            if make is not None:
+                _BLOCK_CACHE.move_to_end(key)
+        if make is None:
+            namespace = {}
+            source = block_source(start, end, ops, dynamic)
+            exec(compile(source, f"<block {start:#x}>", "exec"), namespace)
+            make = namespace["make"]
+            with _BLOCK_CACHE_LOCK:
+                _BLOCK_CACHE[key] = make
+                if len(_BLOCK_CACHE) > BLOCK_CACHE_SIZE:
+                    _BLOCK_CACHE.popitem(last=False)
+
+        entry = (make(self.memory, self._covered, self.invalidate), len(ops))
+        for address in range(start, end):
+            if address not in dynamic:
+                self._covered[address] = 1
+        self.blocks[start] = entry
+        self._spans[start] = end
+        return entry
+
+    def _run_fast(self, budget):
+        """Execute up to budget instructions, whole compiled blocks where they fit"""
+        state = self._state
+        a, z, c = self.A, self.zero_flag, self.carry_flag
+        pc = self.PC
+        executed = 0
+
+        while pc >= 0 and executed < budget:
+            entry = self.blocks[pc]
+            if entry is None:
+                entry = self.compile_block(pc)
+            if entry and entry[1] <= budget - executed:
+                pc, a, z, c, n = entry[0](a, z, c, budget - executed)
+                executed += n
+            else:
+                state[:] = [a, z, c]
+                pc = self.code[pc]()
+                a, z, c = state
+                executed += 1
+
+        if pc < 0:
+            pc = ~pc
+            self.running = False
+        state[:] = [a, z, c]
+        self._sync_out(pc)
+        self.cycles += executed
+        return executed
+
+
+def block_source(start, end, ops, dynamic=()):
+    """Generate the Python source of a block factory for JITCPU.
+
+    LDA/ADD/SUB whose operand address is in dynamic read it from memory.
+    """
+    loop = ops[-1][1] == 0x05 and ops[-1][2] == start
+    length = len(ops)
+
+    # Carry is only worth computing if it can be observed before the next
+    # ADD/SUB overwrites it, i.e. at some exit from the block.
+    carry_live = [False] * length
+    live = True
+    for i in range(length - 1, -1, -1):
+        opcode = ops[i][1]
+        if opcode in (0x04, 0x05, 0x06, 0xFF):
+            live = True
+        elif opcode in (0x02, 0x03):
+            carry_live[i] = live
+            live = False
+
+    lines = [
+        "def make(memory, covered, invalidate):",
+        "    def block(a, z, c, budget):",
+        "        n = 0",
+    ]
+    indent = "        "
+    if loop:
+        lines.append(f"        iterations = range(0, budget - {length} + 1, {length})")
+        lines.append("        for n in iterations:")
+        indent += "    "
+
+    # Every instruction that writes A also sets zero = (A == 0), so after
+    # the first such write the flag never needs its own variable.
+    zero = "z"
+    uses_z = False
+
+    def emit(line):
+        lines.append(indent + line)
+
+    for count, (pc, opcode, operand) in enumerate(ops, 1):
+        if pc + 1 in dynamic:
+            operand = f"memory[{pc + 1}]"
+        if opcode == 0x01:
+            emit(f"a = {operand}")
+            zero = "a == 0"
+        elif opcode in (0x02, 0x03):
+            emit(f"a {'+' if opcode == 0x02 else '-'}= {operand}")
+            if carry_live[count - 1]:
+                emit("c = a > 255" if opcode == 0x02 else "c = a < 0")
+            emit("a &= 255")
+            zero = "a == 0"
+        elif opcode == 0x04:
+            uses_z |= zero == "z"
+            emit(f"memory[{operand}] = a")
+            emit(f"if covered[{operand}]:")
+            emit(f"    invalidate({operand}, {operand + 1})")
+            emit(f"    return {pc + 2}, a, {zero}, c, n + {count}")
+        elif opcode == 0x06:
+            uses_z |= zero == "z"
+            emit(f"if {zero}:")
+            emit(f"    return {operand}, a, True, c, n + {count}")
+        elif opcode == 0x05 and loop:
+            # Falling off the end of the for body is the jump back
+            if zero != "z" and uses_z:
+                emit("z = a == 0")
+            if lines[-1].endswith("in iterations:"):
+                emit("pass")
+            lines.append(f"        return {start}, a, {zero}, c, len(iterations) * {length}")
+        elif opcode == 0x05:
+            emit(f"return {operand}, a, {zero}, c, n + {count}")
+        elif opcode == 0xFF:
+            emit(f"return {~(pc + 1)}, a, {zero}, c, n + {count}")
+
+    if ops[-1][1] not in (0x05, 0xFF):
+        emit(f"return {end}, a, {zero}, c, n + {length}")
+    lines.append("    return block")
+    return "\n".join(lines) + "\n"
+
+
+def iter_images(path, size=1024):
+    """Yield zero-copy views of consecutive size-byte memory images in a corpus file"""
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    for start in range(0, len(view) - size + 1, size):
+        yield view[start:start + size]
@@ -1,5 +1,24 @@
+import mmap
+import os
+import re
+import struct
+import tempfile
+
 from archi import CPU
-from gpu import GPU
+
+SECTIONS = ('CPU', 'GPU')
+OBJECT_MAGIC = b"EMUO"
+OBJECT_VERSION = 1
+OBJECT_HEADER = struct.Struct('<4sBxHII')
+OBJECT_SYMBOL = struct.Struct('<BIB')
+OBJECT_SUFFIX = ".emo"
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "emulator")
+
+# One match per source line: optional "label:", the instruction or directive,
+# then its operands up to any ';' comment
+LINE_PATTERN = re.compile(r'^[ \t\r\f\v]*([^:;\n]*:)?[ \t\r\f\v]*([^\s;]*)([^;\n]*)', re.MULTILINE)
+# Operands is_number accepts, in ASCII digits; anything else names a label
+NUMBER_PATTERN = re.compile(r'0x(?:_?[0-9a-fA-F])+|0b(?:_?[01])+|[-+]?[0-9](?:_?[0-9])*')
 
 class Assembler:
     def __init__(self):
@@ -23,8 +42,29 @@ class Assembler:
             'CLEAR': 0x05,
             'LINE': 0x06,
             'RECT': 0x07,
+            'PAL': 0x08,
+            'BLIT': 0x09,
             'GHALT': 0xFF
         }
+
+        self.cpu_operands = {
+            'NOP': 0, 'LDA': 1, 'ADD': 1, 'SUB': 1,
+            'STA': 1, 'JMP': 1, 'JZ': 1, 'HALT': 0
+        }
+
+        self.gpu_operands = {
+            'GNOP': 0,
+            'SETX': 1,      # x
+            'SETY': 1,      # y
+            'SETC': 3,      # r g b
+            'PLOT': 0,
+            'CLEAR': 0,
+            'LINE': 2,      # x2 y2, drawn from current (X,Y)
+            'RECT': 2,      # width height, filled from current (X,Y)
+            'PAL': 4,       # index r g b, palette entry for indexed VRAM
+            'BLIT': 5,      # address_hi address_lo width height mode, bitmap at current (X,Y)
+            'GHALT': 0
+        }
         
         self.symbols = {}
         
@@ -49,118 +89,218 @@ class Assembler:
             return int(s)
 
     def assemble(self, source):
-        lines = source.split('\n')
-        cleaned_lines = []
-        current_address = 0
+        """Assemble source in one pass, returning a list of machine code bytes.
+
+        CPU and GPU code share one flat address space here; use
+        assemble_object to keep the sections apart.
+        """
+        machine_code = []
+        symbols = self._assemble(source, machine_code, machine_code)
+        self.symbols = {name: address for name, (_, address) in symbols.items()}
+        return machine_code
+
+    def assemble_object(self, source, optimize=False):
+        """Assemble source into an ObjectFile with separate CPU and GPU sections.
+
+        Each section is addressed from 0, so labels in the GPU section
+        are offsets into the GPU program and CPU labels are unaffected
+        by any GPU code in between. optimize runs the GPU section through
+        optimize.optimize_gpu; GPU labels are dropped then, as the
+        commands they pointed at may be gone.
+        """
+        sections = {'CPU': [], 'GPU': []}
+        symbols = self._assemble(source, sections['CPU'], sections['GPU'], max_address=255)
+        for name, code in sections.items():
+            sections[name] = bytes(code)
+        if optimize:
+            from optimize import optimize_gpu  # optimize imports this module
+            sections['GPU'] = optimize_gpu(sections['GPU'])
+            symbols = {name: entry for name, entry in symbols.items() if entry[0] != 'GPU'}
+        self.symbols = {name: address for name, (_, address) in symbols.items()}
+        return ObjectFile(sections['CPU'], sections['GPU'], symbols)
+
+    def assemble_cached(self, source, cache_dir=CACHE_DIR, optimize=False):
+        """assemble_object, reusing the object stored on disk for identical source"""
+        import hashlib
+
+        key = hashlib.blake2b(digest_size=16)
+        key.update(repr((OBJECT_VERSION, optimize, self.cpu_instructions, self.gpu_instructions)).encode())
+        key.update(source.encode())
+        path = os.path.join(cache_dir, key.hexdigest() + OBJECT_SUFFIX)
+
+        if os.path.exists(path):
+            try:
+                obj = ObjectFile.load(path)
+            except ValueError:
+                pass  # truncated or stale, assemble again below
+            else:
+                self.symbols = {name: address for name, (_, address) in obj.symbols.items()}
+                return obj
+
+        obj = self.assemble_object(source, optimize)
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(obj.to_bytes())
+        os.replace(tmp, path)
+        return obj
+
+    def _assemble(self, source, cpu_code, gpu_code, max_address=None):
+        """Single pass over source, appending to the per-section code lists.
+
+        Labels may be used before they are defined: every symbolic operand
+        gets a placeholder plus a fixup, patched once the whole source has
+        been read; with max_address, a label past it is an error rather
+        than a wide operand. Returns the symbol table, name -> (section, address).
+        """
+        symbols = {}
+        fixups = []
+        numbers = {}
+        machine_code = cpu_code
+        emit = machine_code.append
+        instruction_set = self.cpu_instructions
+        operand_counts = self.cpu_operands
         mode = 'CPU'
-        
-        for line in lines:
-            line = line.split(';')[0].strip()
-            if not line:
-                continue
-
-            if line.startswith('.'):
-                directive = line[1:].upper()
-                if directive in ['CPU', 'GPU']:
-                    mode = directive
-                    cleaned_lines.append((mode, line))
+
+        is_number = NUMBER_PATTERN.fullmatch
+        for label, instruction, operands in LINE_PATTERN.findall(source):
+            if not label:
+                if not instruction:
+                    continue
+                if instruction.startswith('.'):
+                    directive = instruction[1:].upper()
+                    if directive == 'CPU' and not operands.strip():
+                        mode, instruction_set, operand_counts = 'CPU', self.cpu_instructions, self.cpu_operands
+                        machine_code = cpu_code
+                    elif directive == 'GPU' and not operands.strip():
+                        mode, instruction_set, operand_counts = 'GPU', self.gpu_instructions, self.gpu_operands
+                        machine_code = gpu_code
+                    else:
+                        raise ValueError(f"Unknown directive: {(instruction + operands).rstrip()}")
+                    emit = machine_code.append
                     continue
-                else:
-                    raise ValueError(f"Unknown directive: {line}")
-
-            if ':' in line:
-                label, rest = line.split(':', 1)
-                label = label.strip()
-                self.symbols[label] = current_address
-                line = rest.strip()
-                if not line:
+            else:
+                symbols[label[:-1].strip()] = (mode, len(machine_code))
+                if not instruction:
                     continue
-            
-            cleaned_lines.append((mode, line))
-            parts = line.split()
-            current_address += 1
-            if len(parts) > 1:
-                current_address += len(parts) - 1
 
-        machine_code = []
-        mode = 'CPU'
-        for stored_mode, line in cleaned_lines:
-            if line.startswith('.'):
-                mode = stored_mode
-                continue
-                
-            parts = line.split()
-            instruction = parts[0].upper()
-
-            instruction_set = self.cpu_instructions if mode == 'CPU' else self.gpu_instructions
-            
-            if instruction not in instruction_set:
+            instruction = instruction.upper()
+            opcode = instruction_set.get(instruction)
+            if opcode is None:
                 raise ValueError(f"Unknown {mode} instruction: {instruction}")
-            
-            machine_code.append(instruction_set[instruction])
-
-            if len(parts) > 1:
-                for operand in parts[1:]:
-                    if self.is_number(operand):
-                        value = self.parse_value(operand)
-                        if value > 255:
-                            raise ValueError(f"Operand value too large: {operand}")
-                        machine_code.append(value)
-                    elif operand in self.symbols:
-                        machine_code.append(self.symbols[operand])
-                    else:
-                        raise ValueError(f"Unknown operand: {operand}")
-        
-        return machine_code
 
-def main(program):
+            operands = operands.split()
+            if len(operands) != operand_counts[instruction]:
+                raise ValueError(f"{instruction} expects {operand_counts[instruction]} operands, got {len(operands)}")
+
+            emit(opcode)
+            for operand in operands:
+                value = numbers.get(operand)
+                if value is None:
+                    if not is_number(operand):
+                        fixups.append((machine_code, len(machine_code), operand))
+                        emit(0)
+                        continue
+                    value = numbers[operand] = self.parse_value(operand)
+                    if value > 255:
+                        raise ValueError(f"Operand value too large: {operand}")
+                emit(value)
+
+        for code, index, operand in fixups:
+            if operand not in symbols:
+                raise ValueError(f"Unknown operand: {operand}")
+            address = symbols[operand][1]
+            if max_address is not None and address > max_address:
+                raise ValueError(f"Operand value too large: {operand} = {address}")
+            code[index] = address
+
+        return symbols
+
+
+class ObjectFile:
+    """Assembled program with explicit CPU and GPU sections and a symbol table.
+
+    Binary layout (little endian):
+
+        header   magic "EMUO", version u8, pad u8, symbol count u16,
+                 CPU section length u32, GPU section length u32
+        CPU section bytes
+        GPU section bytes
+        symbols  section u8 (0 CPU, 1 GPU), address u32, name length u8, name utf-8
+
+    Sections loaded with from_bytes/load are memoryview slices of the
+    buffer, so a mapped file goes straight into CPU.load_program and
+    GPU.load_program without being copied or scanned.
+    """
+
+    def __init__(self, cpu, gpu, symbols=None):
+        self.cpu = cpu
+        self.gpu = gpu
+        self.symbols = symbols or {}  # name -> (section, address)
+
+    def to_bytes(self):
+        parts = [OBJECT_HEADER.pack(OBJECT_MAGIC, OBJECT_VERSION, len(self.symbols),
+                                    len(self.cpu), len(self.gpu)),
+                 self.cpu, self.gpu]
+        for name, (section, address) in self.symbols.items():
+            encoded = name.encode()
+            parts.append(OBJECT_SYMBOL.pack(SECTIONS.index(section), address, len(encoded)))
+            parts.append(encoded)
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Parse an object from any buffer; sections stay views into it"""
+        view = memoryview(data)
+        if len(view) < OBJECT_HEADER.size:
+            raise ValueError("Not an object file: truncated header")
+        magic, version, symbol_count, cpu_size, gpu_size = OBJECT_HEADER.unpack_from(view)
+        if magic != OBJECT_MAGIC:
+            raise ValueError("Not an object file: bad magic")
+        if version != OBJECT_VERSION:
+            raise ValueError(f"Unsupported object version: {version}")
+
+        offset = OBJECT_HEADER.size
+        cpu = view[offset:offset + cpu_size]
+        offset += cpu_size
+        gpu = view[offset:offset + gpu_size]
+        offset += gpu_size
+
+        symbols = {}
+        for _ in range(symbol_count):
+            if offset + OBJECT_SYMBOL.size > len(view):
+                raise ValueError("Not an object file: truncated symbol table")
+            section, address, length = OBJECT_SYMBOL.unpack_from(view, offset)
+            offset += OBJECT_SYMBOL.size
+            symbols[bytes(view[offset:offset + length]).decode()] = (SECTIONS[section], address)
+            offset += length
+        if offset != len(view):
+            raise ValueError("Not an object file: size mismatch")
+        return cls(cpu, gpu, symbols)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        """Map an object file read-only and parse it in place"""
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.from_bytes(data)
+
+
+def main(program, display=True):
+    from gpu import GPU  # keeps numpy/pygame out of plain assembler imports
+
     assembler = Assembler()
     cpu = CPU()
     gpu = GPU()
+    gpu.memory = cpu.memory  # BLIT reads what the CPU left in memory
     
     try:
-        machine_code = assembler.assemble(program)
-        print("Machine code:", [hex(x) for x in machine_code])
-
-        cpu_code = []
-        gpu_code = []
-        current_code = cpu_code
-        mode = 'CPU'
-        
-        i = 0
-        while i < len(machine_code):
-            instruction = machine_code[i]
-
-            if instruction in assembler.cpu_instructions.values():
-                if mode != 'CPU':
-                    mode = 'CPU'
-                    current_code = cpu_code
-                current_code.append(instruction)
-
-                if instruction != 0xFF and instruction != 0x00:
-                    i += 1
-                    if i < len(machine_code):
-                        current_code.append(machine_code[i])
-
-            elif instruction in assembler.gpu_instructions.values():
-                if mode != 'GPU':
-                    mode = 'GPU'
-                    current_code = gpu_code
-                current_code.append(instruction)
-                if instruction == 0x07:
-                    i += 1
-                    current_code.extend(machine_code[i:i+2])
-                    i += 1
-                elif instruction == 0x06:
-                    i += 1
-                    current_code.extend(machine_code[i:i+2])
-                    i += 1
-                elif instruction not in [0x00, 0xFF, 0x04, 0x05]:
-                    i += 1
-                    if i < len(machine_code):
-                        current_code.append(machine_code[i])
-            
-            i += 1
+        obj = assembler.assemble_object(program)
+        cpu_code, gpu_code = obj.cpu, obj.gpu
 
         if cpu_code:
             print("Running CPU code:", [hex(x) for x in cpu_code])
@@ -171,8 +311,8 @@ def main(program):
         if gpu_code:
             print("Running GPU code:", [hex(x) for x in gpu_code])
             gpu.load_program(gpu_code)
-            gpu.run()
-            gpu.display()
+            if display:
+                gpu.display()
         
     except ValueError as e:
         print(f"Assembly error: {e}")
@@ -0,0 +1,164 @@
+import numpy as np
+
+# Per-instance status codes
+RUNNING = 0
+HALTED = 1
+UNKNOWN_INSTRUCTION = 2
+FAULT = 3         # PC or operand fetch ran past the end of memory
+CYCLE_LIMIT = 4
+
+STATUS_NAMES = {
+    RUNNING: "running",
+    HALTED: "halted",
+    UNKNOWN_INSTRUCTION: "unknown-instruction",
+    FAULT: "fault",
+    CYCLE_LIMIT: "cycle-limit",
+}
+
+
+def _as_bytes(data):
+    """uint8 array over a bytes-like object or a list of byte values"""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return np.frombuffer(data, dtype=np.uint8)
+    return np.asarray(data, dtype=np.uint8)
+
+
+class BatchCPU:
+    """N copies of archi.CPU stepped in lockstep over NumPy arrays.
+
+    Registers, flags and the 1KB memories of every instance live in arrays
+    indexed by instance. Each step fetches one instruction per running
+    instance and applies every opcode to the lanes that selected it, so
+    instances may freely diverge on JZ. Instances that halt, hit an unknown
+    opcode or run past memory drop out of the active set.
+
+    Memory holds bytes, so results match archi.CPU for any program whose
+    memory values are 0-255 (everything the assembler produces).
+    """
+
+    def __init__(self, count, memory_size=1024):
+        self.count = count
+        self.memory_size = memory_size
+        self.A = np.zeros(count, dtype=np.int32)
+        self.B = np.zeros(count, dtype=np.int32)
+        self.PC = np.zeros(count, dtype=np.int32)
+        self.zero_flag = np.zeros(count, dtype=bool)
+        self.carry_flag = np.zeros(count, dtype=bool)
+        self.cycles = np.zeros(count, dtype=np.int64)
+        self.status = np.full(count, RUNNING, dtype=np.int8)
+        self.memory = np.zeros((count, memory_size), dtype=np.uint8)
+
+    @classmethod
+    def from_image_file(cls, path, memory_size=1024):
+        """One instance per memory image in a corpus file of concatenated raw images.
+
+        The file is mapped copy-on-write and used as the memory array
+        directly, so nothing is parsed or copied up front.
+        """
+        images = np.memmap(path, dtype=np.uint8, mode='c')
+        count = len(images) // memory_size
+        batch = cls(count, memory_size)
+        batch.memory = images[:count * memory_size].reshape(count, memory_size)
+        return batch
+
+    def load_program(self, program):
+        """Load the same program into every instance"""
+        program = _as_bytes(program)
+        self.memory[:, :len(program)] = program
+
+    def load_memories(self, memories, offset=0):
+        """Overlay per-instance memory: memories[i] is written to instance i at offset"""
+        for i, image in enumerate(memories):
+            image = _as_bytes(image)
+            self.memory[i, offset:offset + len(image)] = image
+
+    def step(self, lanes):
+        """Execute one instruction on each instance in lanes; returns the lanes still running"""
+        size = self.memory_size
+        flat = self.memory.reshape(-1)  # row-major view: instance i starts at i * size
+        pc = self.PC[lanes]
+        base = lanes * size
+
+        fault = pc + 1 >= size
+        opcode = flat[base + np.minimum(pc, size - 1)]
+        operand = flat[base + np.minimum(pc + 1, size - 1)].astype(np.int32)
+        # Only instructions that read an operand (or fetch past the end) can fault
+        fault &= (pc >= size) | ((opcode >= 0x01) & (opcode <= 0x06))
+        if fault.any():
+            self.status[lanes[fault]] = FAULT
+            keep = ~fault
+            lanes, base, pc = lanes[keep], base[keep], pc[keep]
+            opcode, operand = opcode[keep], operand[keep]
+
+        a = self.A[lanes]
+        zero = self.zero_flag[lanes]
+        carry = self.carry_flag[lanes]
+        next_pc = pc + 2
+
+        is_lda = opcode == 0x01
+        is_add = opcode == 0x02
+        is_sub = opcode == 0x03
+        is_sta = opcode == 0x04
+
+        if is_sta.any():
+            flat[base[is_sta] + operand[is_sta]] = a[is_sta]
+
+        result = np.where(is_add, a + operand, np.where(is_sub, a - operand, operand))
+        arith = is_add | is_sub
+        carry = np.where(is_add, result > 255, np.where(is_sub, result < 0, carry))
+        writes_a = arith | is_lda
+        a = np.where(arith, result & 0xFF, np.where(is_lda, result, a))
+        zero = np.where(writes_a, a == 0, zero)
+
+        single = (opcode == 0x00) | (opcode == 0xFF) | (opcode > 0x06)
+        next_pc = np.where(single, pc + 1, next_pc)
+        next_pc = np.where(opcode == 0x05, operand, next_pc)
+        next_pc = np.where((opcode == 0x06) & zero, operand, next_pc)
+
+        self.A[lanes] = a
+        self.zero_flag[lanes] = zero
+        self.carry_flag[lanes] = carry
+        self.PC[lanes] = next_pc
+        self.cycles[lanes] += 1
+
+        stopped = single & (opcode != 0x00)
+        if stopped.any():
+            self.status[lanes[opcode == 0xFF]] = HALTED
+            self.status[lanes[stopped & (opcode != 0xFF)]] = UNKNOWN_INSTRUCTION
+            lanes = lanes[~stopped]
+        return lanes
+
+    def run(self, max_cycles):
+        """Run every instance from address 0 until all stop or max_cycles steps; returns results().
+
+        Unlike archi.CPU there is no endless-loop detection, so a budget is required.
+        """
+        if max_cycles is None or max_cycles < 0:
+            raise ValueError(f"max_cycles must be a non-negative cycle budget, got {max_cycles}")
+        self.PC[:] = 0
+        self.cycles[:] = 0
+        self.status[:] = RUNNING
+        lanes = np.arange(self.count)
+        steps = 0
+        while lanes.size and steps < max_cycles:
+            lanes = self.step(lanes)
+            steps += 1
+        self.status[lanes] = CYCLE_LIMIT
+        return self.results()
+
+    def result(self, i):
+        """Final state of instance i"""
+        return {
+            "A": int(self.A[i]),
+            "B": int(self.B[i]),
+            "PC": int(self.PC[i]),
+            "zero_flag": bool(self.zero_flag[i]),
+            "carry_flag": bool(self.carry_flag[i]),
+            "cycles": int(self.cycles[i]),
+            "status": STATUS_NAMES[int(self.status[i])],
+            "memory": self.memory[i].tobytes(),
+        }
+
+    def results(self):
+        """Final state of every instance, in order"""
+        return [self.result(i) for i in range(self.count)]
@@ -0,0 +1,445 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(ROOT, "bench-baseline.json")
+THRESHOLD = 0.10  # fractional slowdown against the baseline that counts as a regression
+
+IMPORT_SNIPPET = """
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+
+
+def time_import(module, root=ROOT, repeat=7):
+    """Median seconds to import module in a fresh interpreter rooted at root"""
+    env = dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT="1")
+    samples = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-c", IMPORT_SNIPPET.format(module=module)],
+            cwd=root, env=env, capture_output=True, text=True, check=True,
+        )
+        samples.append(float(result.stdout.split()[-1]))
+    return statistics.median(samples)
+
+
+def export_revision(revision, directory):
+    """Check out a git revision of this repository into directory"""
+    archive = subprocess.run(["git", "archive", revision], cwd=ROOT,
+                             capture_output=True, check=True).stdout
+    subprocess.run(["tar", "-x", "-C", directory], input=archive, check=True)
+
+
+def bench_imports(args):
+    """Cold-start cost of importing each emulator module"""
+    modules = ["archi", "assembler", "lang", "gpu"]
+    trees = [("current", ROOT)]
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.against:
+            export_revision(args.against, tmp)
+            trees.insert(0, (args.against, tmp))
+
+        print(f"{'module':<12}" + "".join(f"{name:>14}" for name, _ in trees))
+        for module in modules:
+            times = [time_import(module, root, args.repeat) for _, root in trees]
+            print(f"{module:<12}" + "".join(f"{t * 1000:>12.1f}ms" for t in times))
+
+
+def generate_assembly(lines, seed=0):
+    """Compiler-like assembly: labelled blocks, forward/backward jumps, comments, both sections"""
+    rng = random.Random(seed)
+    out = []
+    block = 0
+    while len(out) < lines:
+        if rng.random() < 0.05:
+            out.append(".GPU")
+            for _ in range(rng.randint(2, 8)):
+                out.append(rng.choice([
+                    f"SETX {rng.randrange(256)}", f"SETY {rng.randrange(256)}",
+                    f"SETC {rng.randrange(256)} {rng.randrange(256)} {rng.randrange(256)}",
+                    "PLOT", f"RECT {rng.randrange(1, 64)} {rng.randrange(1, 64)}",
+                ]))
+            out.append("GHALT")
+            out.append(".CPU")
+            continue
+        out.append(f"block{block}:  ; block {block}")
+        for _ in range(rng.randint(3, 12)):
+            out.append(rng.choice([
+                f"    LDA {rng.randrange(256)}", f"    ADD 0x{rng.randrange(256):02x}",
+                f"    SUB 0b{rng.randrange(256):b}", f"    STA {rng.randrange(32, 256)}",
+                "    NOP",
+            ]))
+        # jump both ways so some references are forward
+        target = rng.randrange(max(block - 20, 0), block + 20)
+        out.append(f"    {rng.choice(['JMP', 'JZ'])} block{target}")
+        block += 1
+    out = out[:lines]
+    out.extend(f"block{i}: HALT" for i in range(block, block + 20))
+    return "\n".join(out)
+
+
+def best_of(repeat, fn, *args):
+    """Fastest wall time of repeat calls to fn(*args)"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_assembler(args):
+    """Assembler.assemble throughput in source lines per second"""
+    from assembler import Assembler
+
+    for lines in (1_000, 10_000, 100_000, 500_000):
+        source = generate_assembly(lines)
+        seconds = best_of(max(args.repeat // 2, 1), Assembler().assemble, source)
+        print(f"{lines:>8} lines {seconds * 1000:>10.1f}ms {lines / seconds:>12,.0f} lines/s")
+
+
+def generate_lang(size, seed=0):
+    """Roughly size bytes of valid .lang source: compute/draw sections, comments, all number forms"""
+    rng = random.Random(seed)
+    out = []
+    names = ["v0"]
+    length = 0
+
+    def operand():
+        return rng.choice(names) if rng.random() < 0.5 else str(rng.randrange(256))
+
+    out.append("compute")
+    out.append("    var v0 = 0")
+    while length < size:
+        if rng.random() < 0.5:
+            chunk = ["compute"]
+            for _ in range(rng.randint(4, 16)):
+                name = f"v{rng.randrange(16)}"
+                chunk.append(rng.choice([
+                    f"    var {name} = {rng.randrange(256)}",
+                    f"    var {name} = 0x{rng.randrange(256):02x}  # hex",
+                    f"    var {name} = 0b{rng.randrange(16):b}",
+                    f"    var {name} = {operand()} + {operand()}",
+                ]))
+                names.append(name)
+        else:
+            chunk = ["draw", "    clear"] + [rng.choice([
+                f"    setpos {operand()} {operand()}",
+                f"    setcolor {operand()} {operand()} {operand()}",
+                f"    rect {rng.randrange(1, 64)} {rng.randrange(1, 64)}",
+                f"    line {operand()} {operand()}",
+                "    plot  # single pixel",
+            ]) for _ in range(rng.randint(4, 16))]
+        out.extend(chunk)
+        length += sum(len(line) + 1 for line in chunk)
+    return "\n".join(out)
+
+
+def bench_lexer(args):
+    """lang tokenizer throughput in tokens per second on multi-megabyte sources"""
+    from lang import tokenize
+
+    def count(source):
+        return sum(1 for _ in tokenize(source))
+
+    for megabytes in (1, 4, 16):
+        source = generate_lang(megabytes << 20)
+        tokens = count(source)
+        seconds = best_of(max(args.repeat // 3, 1), count, source)
+        print(f"{megabytes:>4}MB {tokens:>10,} tokens {seconds * 1000:>10.1f}ms "
+              f"{tokens / seconds:>12,.0f} tokens/s")
+
+
+def generate_cpu_program(loops=10, seed=0):
+    """Chain of countdown loops with random bodies; every loop runs 1-255 times, then HALT.
+
+    Operands are 8 bit, so the code has to fit below the 0xF0-0xFF
+    scratch bytes the bodies store into.
+    """
+    rng = random.Random(seed)
+    out = []
+    for i in range(loops):
+        out.append(f"    LDA {rng.randrange(1, 256)}")
+        out.append(f"loop{i}:")
+        for _ in range(rng.randint(1, 6)):
+            # none of these change A, so the count survives the body
+            out.append(rng.choice(["    NOP", f"    STA {rng.randrange(0xF0, 0x100)}",
+                                   "    ADD 0", "    SUB 0"]))
+        out += ["    SUB 1", f"    JZ next{i}", f"    JMP loop{i}", f"next{i}:"]
+    out.append("    HALT")
+    return "\n".join(out)
+
+
+# Nested countdown loops keeping both counters in their own LDA operands, the
+# only way this ISA has to keep a variable; each run leaves them back at 0
+COUNTER_PROGRAM = """
+outer:  LDA 0
+        SUB 1
+        STA 1
+        JZ done
+inner:  LDA 0
+        SUB 1
+        STA 9
+        JZ outer
+        JMP inner
+done:   HALT
+"""
+
+
+def generate_gpu_program(commands, seed=0):
+    """Random stream of cheap register/plot GPU commands, ending in GHALT"""
+    rng = random.Random(seed)
+    code = bytearray()
+    for _ in range(commands - 1):
+        choice = rng.randrange(5)
+        if choice == 0:
+            code += bytes((0x01, rng.randrange(256)))
+        elif choice == 1:
+            code += bytes((0x02, rng.randrange(256)))
+        elif choice == 2:
+            code += bytes((0x03, rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        elif choice == 3:
+            code.append(0x04)
+        else:
+            code.append(0x00)
+    code.append(0xFF)
+    return bytes(code)
+
+
+def generate_gpu_scene(commands, seed=0):
+    """GPU program of the kind the optimizer targets: plot runs, rects and colour churn"""
+    rng = random.Random(seed)
+    lines = []
+    while len(lines) < commands:
+        lines.append(f"SETC {rng.randrange(8) * 32} {rng.randrange(8) * 32} 0")
+        x, y = rng.randrange(200), rng.randrange(200)
+        lines += [f"SETX {x}", f"SETY {y}"]
+        if rng.random() < 0.5:
+            for i in range(rng.randint(1, 16)):
+                lines += [f"SETX {x + i}", "PLOT"]
+        else:
+            lines.append(f"RECT {rng.randrange(1, 48)} {rng.randrange(1, 48)}")
+    return ".GPU\n" + "\n".join(lines) + "\nGHALT"
+
+
+def measure_cpu(scale, repeat):
+    """archi CPU, DecodedCPU and JITCPU: emulated instructions per second, plain and self-modifying loops"""
+    from archi import CPU, DecodedCPU, JITCPU
+    from assembler import Assembler
+
+    programs = {"": (Assembler().assemble(generate_cpu_program()), max(int(20 * scale), 1)),
+                ".self_modifying": (Assembler().assemble(COUNTER_PROGRAM), max(int(4 * scale), 1))}
+    results = {}
+    for suffix, (code, runs) in programs.items():
+        for cls in (CPU, DecodedCPU, JITCPU):
+            cpu = cls()
+            cpu.load_program(code)
+            cycles = cpu.run() * runs
+            seconds = best_of(repeat, lambda: [cpu.run() for _ in range(runs)])
+            results[f"cpu.{cls.__name__}{suffix}"] = (cycles / seconds, "instructions/s")
+    return results
+
+
+def measure_gpu(scale, repeat):
+    """GPU dispatch, fill rates, surface uploads and VGA frames (RGB and indexed VRAM)"""
+    from gpu import GPU
+
+    gpu = GPU()
+    rng = random.Random(0)
+    commands = max(int(100_000 * scale), 2)
+    program = generate_gpu_program(commands)
+    results = {"gpu.dispatch": (commands / best_of(repeat, gpu.load_program, program), "commands/s")}
+
+    count = max(int(200 * scale), 1)
+    pixels = gpu.width * gpu.height * count
+    seconds = best_of(repeat, lambda: [gpu.clear_screen(i & 0xFF, 0, 0) for i in range(count)])
+    results["gpu.clear_screen"] = (pixels / seconds, "pixels/s")
+
+    rects = []
+    for _ in range(max(int(5_000 * scale), 1)):
+        x, y = rng.randrange(gpu.width), rng.randrange(gpu.height)
+        w, h = rng.randrange(1, 128), rng.randrange(1, 128)
+        rects.append((x, y, w, h))
+    area = sum((min(x + w, gpu.width) - x) * (min(y + h, gpu.height) - y) for x, y, w, h in rects)
+    seconds = best_of(repeat, lambda: [gpu.draw_rectangle(x, y, w, h, 255, 0, 0) for x, y, w, h in rects])
+    results["gpu.draw_rectangle"] = (area / seconds, "pixels/s")
+
+    lines = [(rng.randrange(gpu.width), rng.randrange(gpu.height),
+              rng.randrange(gpu.width), rng.randrange(gpu.height))
+             for _ in range(max(int(5_000 * scale), 1))]
+    length = sum(max(abs(x2 - x1), abs(y2 - y1)) + 1 for x1, y1, x2, y2 in lines)
+    seconds = best_of(repeat, lambda: [gpu.draw_line(*line, 0, 255, 0) for line in lines])
+    results["gpu.draw_line"] = (length / seconds, "pixels/s")
+
+    sprites = [rng.randbytes(16 * 16) for _ in range(8)]
+    for i, sprite in enumerate(sprites):
+        gpu.load_sprites(sprite, i * 256)
+    blits = [(x, y, rng.randrange(8) * 256, rng.choice((0x01, 0x05, 0x15)))
+             for x, y, _, _ in rects]
+    area = sum((min(x + 16 * ((mode >> 4) + 1), gpu.width) - x) * (min(y + 16 * ((mode >> 4) + 1), gpu.height) - y)
+               for x, y, _, mode in blits)
+    seconds = best_of(repeat, lambda: [gpu.draw_bitmap(x, y, address, 16, 16, mode)
+                                       for x, y, address, mode in blits])
+    results["gpu.draw_bitmap"] = (area / seconds, "pixels/s")
+
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+    frames = max(int(50 * scale), 1)
+    indexed = GPU(indexed=True)
+    for x, y, w, h in rects:
+        indexed.draw_rectangle(x, y, w, h, x & 0xE0, y & 0xE0, 0)
+    for prefix, target in (("gpu", gpu), ("gpu.indexed", indexed)):
+        seconds = best_of(repeat, lambda: [target.get_pygame_surface() for _ in range(frames)])
+        results[f"{prefix}.get_pygame_surface"] = (frames / seconds, "frames/s")
+
+        def vga():
+            for i in range(frames):
+                target.draw_rectangle(i, 0, 1, 1, 0, 0, 0)  # invalidate the cached frame
+                target.vga_frame()
+        results[f"{prefix}.vga_frame"] = (frames / best_of(repeat, vga), "frames/s")
+    return results
+
+
+def measure_optimizer(scale, repeat):
+    """optimize.optimize_gpu throughput on generated scenes"""
+    from assembler import Assembler
+    from optimize import optimize_gpu
+
+    code = Assembler().assemble_object(generate_gpu_scene(max(int(20_000 * scale), 1))).gpu
+    return {"optimize.optimize_gpu": (len(code) / best_of(repeat, optimize_gpu, code), "bytes/s")}
+
+
+def measure_assembler(scale, repeat):
+    """Assembler.assemble on generated sources"""
+    from assembler import Assembler
+
+    lines = max(int(100_000 * scale), 1)
+    source = generate_assembly(lines)
+    return {"assembler.assemble": (lines / best_of(repeat, Assembler().assemble, source), "lines/s")}
+
+
+def measure_lang(scale, repeat):
+    """lang Lexer and Compiler on generated sources"""
+    from lang import Compiler, Lexer
+
+    source = generate_lang(max(int((1 << 20) * scale), 1))
+    tokens = sum(1 for _ in Lexer(source))
+    lex = best_of(repeat, lambda: sum(1 for _ in Lexer(source)))
+    compile_ = best_of(repeat, lambda: Compiler().compile(source))
+    return {"lang.Lexer": (tokens / lex, "tokens/s"),
+            "lang.Compiler": (tokens / compile_, "tokens/s")}
+
+
+# group -> measure(scale, repeat) returning {metric: (rate, unit)}; higher is better throughout
+SUITE = {
+    "cpu": measure_cpu,
+    "gpu": measure_gpu,
+    "optimizer": measure_optimizer,
+    "assembler": measure_assembler,
+    "lang": measure_lang,
+}
+
+
+def run_suite(groups=None, scale=1.0, repeat=5):
+    """Run the suite, returning a JSON-ready report"""
+    metrics = {}
+    for group in groups or SUITE:
+        for name, (value, unit) in SUITE[group](scale, repeat).items():
+            metrics[name] = {"value": value, "unit": unit}
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "scale": scale,
+        "metrics": metrics,
+    }
+
+
+def compare(report, baseline, threshold=THRESHOLD, thresholds=None):
+    """Rows of (metric, baseline, current, change, regressed) for metrics in both reports"""
+    thresholds = thresholds or {}
+    rows = []
+    for name, entry in report["metrics"].items():
+        before = baseline["metrics"].get(name)
+        if before is None:
+            continue
+        change = entry["value"] / before["value"] - 1
+        rows.append((name, before["value"], entry["value"], change,
+                     change < -thresholds.get(name, threshold)))
+    return rows
+
+
+def bench_suite(args):
+    """Every hot path as JSON, optionally checked against a stored baseline"""
+    report = run_suite(args.only, args.scale, args.repeat)
+    text = json.dumps(report, indent=2)
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            f.write(text + "\n")
+        print(f"baseline saved to {args.baseline}", file=sys.stderr)
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    thresholds = {}
+    for item in args.threshold_for:
+        name, _, value = item.partition("=")
+        thresholds[name] = float(value)
+    rows = compare(report, baseline, args.threshold, thresholds)
+    for name, before, after, change, regressed in rows:
+        print(f"{name:<26}{before:>16,.0f}{after:>16,.0f}{change:>+9.1%}"
+              f"{'  REGRESSION' if regressed else ''}", file=sys.stderr)
+    regressions = sum(row[4] for row in rows)
+    print(f"{regressions} of {len(rows)} metrics regressed", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+BENCHMARKS = {
+    "imports": bench_imports,
+    "assembler": bench_assembler,
+    "lexer": bench_lexer,
+    "suite": bench_suite,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Emulator benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--against", metavar="REV",
+                        help="also measure this git revision, for before/after numbers")
+    parser.add_argument("--only", action="append", choices=sorted(SUITE),
+                        help="suite: run just this group (repeatable)")
+    parser.add_argument("--scale", type=float, default=1.0, help="suite: workload size multiplier")
+    parser.add_argument("--json", metavar="PATH", help="suite: write the report here instead of stdout")
+    parser.add_argument("--baseline", metavar="PATH", default=BASELINE,
+                        help="suite: baseline report to compare against (default: %(default)s)")
+    parser.add_argument("--save-baseline", action="store_true", help="suite: store this run as the baseline")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="suite: slowdown that fails the run, as a fraction (default: %(default)s)")
+    parser.add_argument("--threshold-for", action="append", default=[], metavar="METRIC=FRACTION",
+                        help="suite: per-metric threshold, e.g. gpu.get_pygame_surface=0.25")
+    args = parser.parse_args(argv)
+    return BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
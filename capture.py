@@ -0,0 +1,159 @@
+import argparse
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from assembler import Assembler
+from gpu import GPU
+
+BUFFER_SIZE = 1 << 20  # bytes of file buffering per writer
+
+
+def encode_png(frame, level=6):
+    """Encode an (height, width, 3) uint8 frame as PNG bytes"""
+    height, width, _ = frame.shape
+    # Every scanline starts with a filter-type byte; 0 means "no filter"
+    rows = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    rows[:, 1:] = frame.reshape(height, width * 3)
+
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data +
+                struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) +
+            chunk(b"IDAT", zlib.compress(rows.tobytes(), level)) + chunk(b"IEND", b""))
+
+
+class RawWriter:
+    """Append frames to one file as packed RGB24"""
+
+    def __init__(self, path):
+        self.file = open(path, "wb", buffering=BUFFER_SIZE)
+        self.frames = 0
+
+    def write(self, frame):
+        self.file.write(np.ascontiguousarray(frame).data)
+        self.frames += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PNGWriter:
+    """Write each frame to its own PNG file, named from a %-style pattern"""
+
+    def __init__(self, pattern="frame_%05d.png", level=6):
+        self.pattern = pattern
+        self.level = level
+        self.frames = 0
+        directory = os.path.dirname(pattern)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def write(self, frame):
+        with open(self.pattern % self.frames, "wb") as f:
+            f.write(encode_png(frame, self.level))
+        self.frames += 1
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Y4MWriter:
+    """Stream frames as a YUV4MPEG2 (4:4:4, BT.601 studio range) video"""
+
+    # RGB -> YCbCr rows, scaled for 0..255 input
+    MATRIX = np.array([
+        [65.481, 128.553, 24.966],
+        [-37.797, -74.203, 112.0],
+        [112.0, -93.786, -18.214],
+    ], dtype=np.float32) / 255.0
+    OFFSET = np.array([16.0, 128.0, 128.0], dtype=np.float32)
+
+    def __init__(self, path, width, height, fps=60):
+        self.file = open(path, "wb", buffering=BUFFER_SIZE)
+        self.file.write(f"YUV4MPEG2 W{width} H{height} F{fps}:1 Ip A1:1 C444\n".encode())
+        self.frames = 0
+
+    def write(self, frame):
+        yuv = frame.astype(np.float32) @ self.MATRIX.T + self.OFFSET
+        planes = np.rint(yuv).clip(0, 255).astype(np.uint8).transpose(2, 0, 1)
+        self.file.write(b"FRAME\n")
+        self.file.write(np.ascontiguousarray(planes).data)
+        self.frames += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def capture(gpu, program, writer=None, callback=None, max_frames=None):
+    """Run a GPU program headlessly, streaming each finished frame.
+
+    Frames go to writer.write() and/or callback(index, frame) as they are
+    produced, so nothing is held beyond the current VRAM. Returns the number
+    of frames produced.
+    """
+    count = 0
+    for frame in gpu.frames(program):
+        if writer is not None:
+            writer.write(frame)
+        if callback is not None:
+            callback(count, frame)
+        count += 1
+        if max_frames is not None and count >= max_frames:
+            break
+    return count
+
+
+def open_writer(fmt, output, width, height, fps=60):
+    """Create the writer for a --format name"""
+    if fmt == "raw":
+        return RawWriter(output)
+    if fmt == "png":
+        return PNGWriter(os.path.join(output, "frame_%05d.png"))
+    if fmt == "y4m":
+        return Y4MWriter(output, width, height, fps)
+    raise ValueError(f"Unknown capture format: {fmt}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run GPU assembly headlessly and capture its frames")
+    parser.add_argument("source", help="GPU assembly file (each GHALT ends a frame)")
+    parser.add_argument("output", help="output file, or directory for --format png")
+    parser.add_argument("--format", choices=["raw", "png", "y4m"], default="png")
+    parser.add_argument("--fps", type=int, default=60)
+    parser.add_argument("--max-frames", type=int)
+    args = parser.parse_args(argv)
+
+    with open(args.source) as f:
+        program = Assembler().assemble_object(".GPU\n" + f.read()).gpu
+
+    gpu = GPU()
+    with open_writer(args.format, args.output, gpu.width, gpu.height, args.fps) as writer:
+        count = capture(gpu, program, writer, max_frames=args.max_frames)
+    print(f"Captured {count} frames to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import math
+from collections import deque
+
+from assembler import Assembler
+
+_assembler = Assembler()
+GPU_OPERANDS = {_assembler.gpu_instructions[name]: count
+                for name, count in _assembler.gpu_operands.items()}
+GHALT = _assembler.gpu_instructions['GHALT']
+
+FIFO_BASE = 0xF0      # STA to any address in [FIFO_BASE, FIFO_BASE + FIFO_SIZE) feeds the GPU
+FIFO_SIZE = 16
+FIFO_DEPTH = 64       # bytes queued before the CPU stalls
+SLICE_CYCLES = 256    # CPU cycles between GPU turns
+CPU_HZ = 1_000_000
+FRAME_RATE = 60
+
+
+class FrameStats:
+    """Cycle accounting for one frame, which the GPU ends by executing GHALT.
+
+    cycles is elapsed CPU clock time; cpu_cycles of it retired
+    instructions and stall_cycles were spent waiting on a full FIFO.
+    gpu_cycles executed commands and gpu_idle_cycles found none queued.
+    """
+
+    __slots__ = ("index", "cycles", "cpu_cycles", "stall_cycles", "gpu_cycles",
+                 "gpu_idle_cycles", "fifo_peak", "complete", "cpu_budget", "gpu_budget")
+
+    def __init__(self, index, cpu_budget, gpu_budget):
+        self.index = index
+        self.cycles = 0
+        self.cpu_cycles = 0
+        self.stall_cycles = 0
+        self.gpu_cycles = 0
+        self.gpu_idle_cycles = 0
+        self.fifo_peak = 0
+        self.complete = False
+        self.cpu_budget = cpu_budget
+        self.gpu_budget = gpu_budget
+
+    @property
+    def on_time(self):
+        """Whether the frame fit in its 1/frame_rate slot"""
+        return self.cycles <= self.cpu_budget
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__} | {"on_time": self.on_time}
+
+
+class Scheduler:
+    """Time-slices an archi.CPU and a gpu.GPU, the CPU feeding the GPU through a FIFO.
+
+    STA into the FIFO region of CPU memory pushes A onto the GPU command
+    queue instead of writing memory. A full queue stalls the STA until
+    the GPU has made room. The GPU runs one command per GPU cycle, ratio
+    CPU cycles each; batch lets it drain everything queued at each turn,
+    running ahead of its budget and paying the cycles back afterwards,
+    so frame boundaries are only approximate in time.
+
+    The CPU is stepped with fetch and execute, which dispatch through
+    cpu.instructions on archi.CPU and its subclasses alike, so STA is
+    always the scheduler's.
+    """
+
+    def __init__(self, cpu, gpu, ratio=4, fifo_base=FIFO_BASE, fifo_size=FIFO_SIZE,
+                 depth=FIFO_DEPTH, slice_cycles=SLICE_CYCLES, batch=False,
+                 cpu_hz=CPU_HZ, frame_rate=FRAME_RATE):
+        if depth <= max(GPU_OPERANDS.values()):
+            # a full FIFO must hold a whole command, or the CPU and GPU wait on each other forever
+            raise ValueError(f"FIFO depth {depth} is too shallow for a {max(GPU_OPERANDS.values()) + 1}-byte command")
+        self.cpu = cpu
+        self.gpu = gpu
+        self.ratio = ratio
+        self.fifo_base = fifo_base
+        self.fifo_end = fifo_base + fifo_size
+        self.depth = depth
+        self.slice_cycles = slice_cycles
+        self.batch = batch
+        self.cpu_budget = cpu_hz // frame_rate
+        self.gpu_budget = self.cpu_budget // ratio
+
+        self.fifo = deque()
+        self.stalled = False
+        self.cycles = 0
+        self.frames = []
+        self.frame = FrameStats(0, self.cpu_budget, self.gpu_budget)
+        cpu.instructions[0x04] = self.sta
+        gpu.memory = cpu.memory  # BLIT reads the bitmap as the CPU has it at that moment
+
+    def sta(self):
+        """STA that turns stores into the FIFO region into GPU command bytes"""
+        cpu = self.cpu
+        address = cpu.memory[cpu.PC]
+        if not self.fifo_base <= address < self.fifo_end:
+            cpu.PC += 1
+            cpu.memory[address] = cpu.A
+        elif len(self.fifo) < self.depth:
+            cpu.PC += 1
+            self.fifo.append(cpu.A)
+        else:
+            cpu.PC -= 1  # back onto the opcode: retried once there is room
+            self.stalled = True
+
+    def run(self, max_cycles=None, max_frames=None):
+        """Run from CPU address 0 until the CPU halts and the FIFO is drained.
+
+        Returns the FrameStats of every frame, the last one marked
+        incomplete if the GPU never reached its GHALT.
+        """
+        cpu = self.cpu
+        cpu.PC = 0
+        cpu.running = True
+        credit = 0.0  # GPU cycles the elapsed CPU time has paid for
+
+        while max_cycles is None or self.cycles < max_cycles:
+            if max_frames is not None and len(self.frames) >= max_frames:
+                break
+            frame = self.frame
+            if cpu.running:
+                budget = self.slice_cycles
+                if max_cycles is not None:
+                    budget = min(budget, max_cycles - self.cycles)
+                elapsed = self._run_cpu(budget)
+            elif self._queued():
+                # Only the GPU is left: let just enough time pass for its next command
+                elapsed = max(math.ceil((1 - credit) * self.ratio), 0)
+            else:
+                break
+            self.cycles += elapsed
+            frame.cycles += elapsed
+            credit += elapsed / self.ratio
+
+            credit = self._run_gpu(credit)
+            if self.stalled and len(self.fifo) >= self.depth:
+                # Still full: fast-forward the stall until the GPU has earned one more command
+                wait = math.ceil((1 - credit) * self.ratio)
+                self.cycles += wait
+                self.frame.cycles += wait
+                self.frame.stall_cycles += wait
+                credit = self._run_gpu(credit + wait / self.ratio)
+
+        # the frame left open only counts if something ran in it, even just a command after GHALT
+        open_frame = self.frame.cycles or self.frame.gpu_cycles
+        if credit < 0:
+            # batch ran the GPU ahead of the clock; the run ends when it would have finished,
+            # which is owed by the open frame or else by the one GHALT just closed
+            debt = math.ceil(-credit * self.ratio)
+            self.cycles += debt
+            (self.frame if open_frame else self.frames[-1]).cycles += debt
+        if open_frame:
+            self.frames.append(self.frame)
+            self.frame = FrameStats(len(self.frames), self.cpu_budget, self.gpu_budget)
+        return self.frames
+
+    def _run_cpu(self, cycles):
+        """Step the CPU for up to cycles, stopping early on halt or a FIFO stall"""
+        cpu = self.cpu
+        frame = self.frame
+        self.stalled = False
+        executed = 0
+        while executed < cycles and cpu.running:
+            cpu.execute(cpu.fetch())
+            executed += 1
+            if self.stalled:
+                frame.stall_cycles += 1
+                frame.cpu_cycles += executed - 1
+                return executed
+        frame.cpu_cycles += executed
+        return executed
+
+    def _queued(self):
+        """Whether the FIFO holds a complete command"""
+        fifo = self.fifo
+        if not fifo:
+            return False
+        count = GPU_OPERANDS.get(fifo[0])
+        if count is None:
+            raise ValueError(f"Unknown GPU instruction: {hex(fifo[0])}")
+        return len(fifo) > count
+
+    def _run_gpu(self, credit):
+        """Execute queued commands against credit; returns the credit left"""
+        gpu = self.gpu
+        fifo = self.fifo
+        self.frame.fifo_peak = max(self.frame.fifo_peak, len(fifo))
+        while (credit >= 1 or self.batch) and self._queued():
+            opcode = fifo[0]
+            gpu.program = bytes(fifo.popleft() for _ in range(GPU_OPERANDS[opcode] + 1))
+            gpu.PC = 0
+            gpu.instructions[opcode]()
+            credit -= 1
+            self.frame.gpu_cycles += 1
+            if opcode == GHALT:
+                self.frame.complete = True
+                self.frames.append(self.frame)
+                self.frame = FrameStats(len(self.frames), self.cpu_budget, self.gpu_budget)
+        if credit >= 1:
+            idle = int(credit)  # nothing to do; idle cycles cannot be banked
+            self.frame.gpu_idle_cycles += idle
+            credit -= idle
+        return credit
+
+
+def main(argv=None):
+    import argparse
+    import json
+
+    from archi import CPU
+    from gpu import GPU
+
+    parser = argparse.ArgumentParser(description="Co-simulate a CPU program that draws through the GPU FIFO")
+    parser.add_argument("source", help="assembly whose CPU code STAs GPU commands into the FIFO region")
+    parser.add_argument("--ratio", type=int, default=4, help="CPU cycles per GPU cycle")
+    parser.add_argument("--depth", type=int, default=FIFO_DEPTH)
+    parser.add_argument("--slice", type=int, default=SLICE_CYCLES, dest="slice_cycles")
+    parser.add_argument("--batch", action="store_true", help="drain the whole FIFO at each GPU turn")
+    parser.add_argument("--cpu-hz", type=int, default=CPU_HZ)
+    parser.add_argument("--max-cycles", type=int)
+    parser.add_argument("--display", action="store_true", help="show the final frame")
+    args = parser.parse_args(argv)
+
+    with open(args.source) as f:
+        obj = Assembler().assemble_object(f.read())
+    cpu = CPU()
+    gpu = GPU()
+    cpu.load_program(obj.cpu)
+    scheduler = Scheduler(cpu, gpu, args.ratio, depth=args.depth, slice_cycles=args.slice_cycles,
+                          batch=args.batch, cpu_hz=args.cpu_hz)
+    frames = scheduler.run(args.max_cycles)
+    for stats in frames:
+        print(json.dumps(stats.as_dict()))
+    late = sum(not stats.on_time for stats in frames)
+    print(f"{len(frames)} frames, {late} over the {scheduler.cpu_budget}-cycle budget")
+    if args.display:
+        gpu.display()
+
+
+if __name__ == "__main__":
+    main()
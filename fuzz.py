@@ -0,0 +1,766 @@
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+
+from archi import CPU, DecodedCPU, JITCPU
+
+OPCODES = (0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0xFF, 0x07)  # 0x07 is unknown
+MAX_CYCLES = 500  # per program, well under archi.IDLE_CHECK_INTERVAL
+
+
+def reference_cpu(program, max_cycles):
+    """The original list-memory CPU loop, stopped after max_cycles instructions.
+
+    Returns (A, PC, zero, carry, memory, running, cycles), or None when the
+    program runs off the end of memory.
+    """
+    memory = [0] * 1024
+    memory[:len(program)] = program
+    a = pc = cycles = 0
+    zero = carry = False
+    running = True
+    try:
+        while running and cycles < max_cycles:
+            opcode = memory[pc]
+            pc += 1
+            if opcode == 0x00:
+                pass
+            elif opcode == 0x01:
+                a = memory[pc]
+                pc += 1
+                zero = a == 0
+            elif opcode in (0x02, 0x03):
+                result = a + memory[pc] if opcode == 0x02 else a - memory[pc]
+                pc += 1
+                carry = result > 255 if opcode == 0x02 else result < 0
+                a = result & 0xFF
+                zero = a == 0
+            elif opcode == 0x04:
+                memory[memory[pc]] = a
+                pc += 1
+            elif opcode == 0x05:
+                pc = memory[pc]
+            elif opcode == 0x06:
+                address = memory[pc]
+                pc += 1
+                if zero:
+                    pc = address
+            else:
+                running = False  # HALT, or an unknown opcode
+            cycles += 1
+    except IndexError:
+        return None
+    return a, pc, zero, carry, bytes(memory), running, cycles
+
+
+def random_program(rng, instructions=40, reach=60):
+    """Random CPU code using every opcode and an unknown one.
+
+    Jump and store targets stay below reach, inside or just past the
+    code, so programs loop and overwrite their own instructions.
+    """
+    program = []
+    for _ in range(rng.randint(1, instructions)):
+        opcode = rng.choice(OPCODES)
+        program.append(opcode)
+        if opcode in (0x04, 0x05, 0x06):
+            program.append(rng.randrange(reach))
+        elif opcode in (0x01, 0x02, 0x03):
+            program.append(rng.randrange(256))
+    return program
+
+
+def cpu_state(cpu, cycles):
+    return cpu.A, cpu.PC, cpu.zero_flag, cpu.carry_flag, bytes(cpu.memory), cpu.running, cycles
+
+
+def compare_cpu(make, program, max_cycles=MAX_CYCLES):
+    """Run program on a fresh make() CPU and the reference; raise AssertionError if they differ.
+
+    Returns False when the reference runs off memory and nothing was compared.
+    """
+    expected = reference_cpu(program, max_cycles)
+    if expected is None:
+        return False
+    cpu = make()
+    cpu.load_program(program)
+    with contextlib.redirect_stdout(io.StringIO()):  # unknown-opcode diagnostics
+        cycles = cpu.run(max_cycles)
+    actual = cpu_state(cpu, cycles)
+    if actual != expected:
+        raise AssertionError(f"{type(cpu).__name__} differs on {program} ({max_cycles} cycles): "
+                             f"A/PC/zero/carry/running/cycles {_registers(actual)}, "
+                             f"expected {_registers(expected)}")
+    return True
+
+
+def _registers(state):
+    a, pc, zero, carry, _, running, cycles = state
+    return a, pc, zero, carry, running, cycles
+
+
+def check_cpu(count, seed):
+    """CPU and DecodedCPU against the reference interpreter on random programs"""
+    rng = random.Random(seed)
+    checked = 0
+    for _ in range(count):
+        program = random_program(rng)
+        max_cycles = rng.randint(1, MAX_CYCLES)
+        for make in (CPU, DecodedCPU):
+            checked += compare_cpu(make, program, max_cycles)
+    return checked
+
+
+# Programs that store over code a compiled JIT block has already covered
+SELF_MODIFYING = [
+    # counts down by rewriting the operand of its own LDA
+    [0x01, 5, 0x03, 1, 0x04, 1, 0x06, 10, 0x05, 0, 0xFF],
+    # turns the ADD later in the running block into a HALT
+    [0x01, 0xFF, 0x04, 5, 0x00, 0x02, 1, 0xFF],
+    # a block that jumps to its own entry (compiled as a while loop) doubles its ADD operand
+    [0x02, 1, 0x04, 1, 0x06, 8, 0x05, 0, 0xFF],
+    # redirects the JMP at the end of the running block
+    [0x01, 10, 0x04, 7, 0x00, 0x00, 0x05, 0, 0x01, 1, 0xFF],
+]
+
+
+def check_profiler(count, seed):
+    """Profiled runs against the reference interpreter and the plain interpreters.
+
+    A profiled CPU run must reach the reference state and halt_reason, with
+    counters that add up to the cycles run, and continuing it unprofiled
+    must land where an unprofiled run would. A profiled GPU program must
+    draw exactly what the plain GPU draws.
+    """
+    from gpu import GPU
+    from instrument import Profiler
+
+    rng = random.Random(seed)
+    checked = 0
+    for _ in range(count):
+        program = random_program(rng)
+        max_cycles = rng.randint(1, MAX_CYCLES)
+        split = rng.randint(0, max_cycles)
+        expected = reference_cpu(program, max_cycles)
+        if expected is not None:
+            partial = reference_cpu(program, split)
+            for make in (CPU, DecodedCPU, JITCPU):
+                cpu = make()
+                cpu.load_program(program)
+                profiler = Profiler(trace_size=rng.choice((0, 1, 16)))
+                with contextlib.redirect_stdout(io.StringIO()):
+                    cycles = cpu.run(split, profiler=profiler)
+                _compare_profiled(cpu, cycles, partial, profiler, f"{make.__name__} on {program} ({split} cycles)")
+                if cpu.running:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        cycles += cpu.resume(max_cycles - split)
+                    if cpu_state(cpu, cycles) != expected:
+                        raise AssertionError(f"{make.__name__} differs on {program} resumed unprofiled after "
+                                             f"{split} of {max_cycles} cycles: A/PC/zero/carry/running/cycles "
+                                             f"{_registers(cpu_state(cpu, cycles))}, expected {_registers(expected)}")
+                checked += 1
+
+        width, height = rng.choice([(32, 24), (300, 20)])
+        indexed = rng.random() < 0.3
+        memory = bytearray(rng.randbytes(1024))
+        code = random_gpu_program(rng, rng.randint(1, 100))
+        runs = []
+        for profiler in (None, Profiler()):
+            gpu = GPU(width, height, indexed=indexed)
+            gpu.memory = memory
+            try:
+                gpu.load_program(code, profiler)
+                runs.append((gpu.to_rgb().tobytes(), gpu.PC, gpu.current_x, gpu.current_y,
+                             gpu.current_r, gpu.current_g, gpu.current_b))
+            except (ValueError, IndexError) as e:
+                runs.append((type(e).__name__, gpu.to_rgb().tobytes()))
+        if runs[0] != runs[1]:
+            raise AssertionError(f"profiled GPU differs on {list(code)} on a "
+                                 f"{width}x{height}{' indexed' if indexed else ''} GPU")
+        checked += 1
+    return checked
+
+
+def _compare_profiled(cpu, cycles, expected, profiler, where):
+    actual = cpu_state(cpu, cycles)
+    if actual != expected:
+        raise AssertionError(f"profiled {where}: A/PC/zero/carry/running/cycles {_registers(actual)}, "
+                             f"expected {_registers(expected)}")
+    if cpu.running:
+        reason = "cycle-limit"
+    else:
+        reason = "halt" if cpu.memory[cpu.PC - 1] == 0xFF else "unknown-instruction"
+    if cpu.halt_reason != reason or cpu.cycles != cycles:
+        raise AssertionError(f"profiled {where}: halt_reason {cpu.halt_reason}, cycles {cpu.cycles}, "
+                             f"expected {reason}, {cycles}")
+    counts = {opcode: n for (unit, opcode), n in profiler.opcode_counts.items() if unit == "cpu"}
+    hits = sum(n for (unit, _), n in profiler.pc_hits.items() if unit == "cpu")
+    if sum(counts.values()) != cycles or hits != cycles or profiler.cycles != cycles:
+        raise AssertionError(f"profiled {where}: counted {sum(counts.values())} opcodes, {hits} pc hits, "
+                             f"{profiler.cycles} cycles for {cycles}")
+    if sum(profiler.memory_writes) != counts.get(0x04, 0):
+        raise AssertionError(f"profiled {where}: {sum(profiler.memory_writes)} memory writes "
+                             f"for {counts.get(0x04, 0)} STAs")
+    trace = profiler.trace
+    if trace is not None and (len(trace) != min(trace.maxlen, cycles) or trace and trace[-1][1] != cycles):
+        raise AssertionError(f"profiled {where}: trace of {len(trace)} ending {trace and trace[-1]}")
+
+
+def check_jit(count, seed):
+    """JITCPU against the reference interpreter on self-modifying and random programs.
+
+    Every program runs on a fresh JITCPU and on one reused across programs
+    via reset(), so stale blocks in the shared cache would show up too.
+    """
+    rng = random.Random(seed)
+    warm = JITCPU()
+
+    def reuse():
+        warm.reset()
+        return warm
+
+    checked = 0
+    for program in SELF_MODIFYING:
+        for make in (JITCPU, reuse):
+            if not compare_cpu(make, program, 10 * MAX_CYCLES):
+                raise AssertionError(f"reference ran off memory on {program}")
+            checked += 1
+    for _ in range(count):
+        program = random_program(rng)
+        max_cycles = rng.randint(1, MAX_CYCLES)
+        for make in (JITCPU, reuse):
+            checked += compare_cpu(make, program, max_cycles)
+    return checked
+
+
+def check_batch(count, seed):
+    """BatchCPU against the reference interpreter, one random program per instance"""
+    from batchcpu import BatchCPU
+
+    rng = random.Random(seed)
+    programs = [random_program(rng) for _ in range(count)]
+    batch = BatchCPU(count)
+    batch.load_memories(programs)
+    for program, result in zip(programs, batch.run(MAX_CYCLES)):
+        expected = reference_cpu(program, MAX_CYCLES)
+        if expected is None:
+            status = "fault"
+        elif expected[5]:
+            status = "cycle-limit"
+        else:
+            status = "halted" if expected[4][expected[1] - 1] == 0xFF else "unknown-instruction"
+        if result["status"] != status:
+            raise AssertionError(f"BatchCPU stopped with {result['status']} on {program}, expected {status}")
+        if expected is None:
+            continue
+        actual = (result["A"], result["PC"], result["zero_flag"], result["carry_flag"],
+                  result["memory"], status == "cycle-limit", result["cycles"])
+        if actual != expected:
+            raise AssertionError(f"BatchCPU differs on {program}: A/PC/zero/carry/running/cycles "
+                                 f"{_registers(actual)}, expected {_registers(expected)}")
+    return count
+
+
+def check_snapshot(count, seed):
+    """Recorder.rewind against the reference interpreter stopped at the target cycle.
+
+    Random programs run in bursts on every CPU class with a small GPU
+    attached that is drawn on between bursts, rewinding a random distance
+    after each one. The CPU must match the reference at the cycle reached,
+    and the GPU the picture it showed when the restored snapshot was taken.
+    """
+    from gpu import GPU
+    from snapshot import Recorder
+
+    rng = random.Random(seed)
+    checked = 0
+    for _ in range(count):
+        program = random_program(rng)
+        limit = rng.randint(1, MAX_CYCLES)
+        if reference_cpu(program, limit) is None:
+            continue
+        indexed = rng.random() < 0.3
+        for make in (CPU, DecodedCPU, JITCPU):
+            cpu = make()
+            cpu.load_program(program)
+            gpu = GPU(32, 24, indexed=indexed)
+            recorder = Recorder(cpu, gpu, interval=rng.randint(1, 50), chunk_size=rng.choice((64, 100, 4096)))
+            pictures = {}  # id(snapshot) -> (snapshot, GPU picture and palette when it was taken)
+            for _ in range(3):
+                gpu.draw_rectangle(rng.randrange(32), rng.randrange(24), rng.randint(1, 8), rng.randint(1, 8),
+                                   *rng.choice([(255, 0, 0), (0, 255, 0), (9, 9, 9), (0, 0, 0)]))
+                if cpu.running or not cpu.cycles:  # a halted CPU would run on past its HALT
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        recorder.run(rng.randint(1, limit - min(cpu.cycles, limit - 1)))
+                for snap in recorder.snapshots:
+                    pictures.setdefault(id(snap), (snap, _picture(gpu)))
+                where = f"{make.__name__} on {program}"
+                _compare_rewound(cpu, program, f"after running to cycle {cpu.cycles}: {where}")
+
+                distance = rng.randint(0, cpu.cycles)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    recorder.rewind(distance)
+                _compare_rewound(cpu, program, f"after rewinding {distance} to cycle {cpu.cycles}: {where}")
+                _, picture = pictures[id(recorder.snapshots[-1])]
+                if _picture(gpu) != picture:
+                    raise AssertionError(f"GPU not restored after rewinding {distance} to cycle {cpu.cycles}: {where}")
+                checked += 1
+    return checked
+
+
+def _picture(gpu):
+    """What a rewind must restore on the GPU: the frame and the palette bookkeeping"""
+    return gpu.to_rgb().tobytes(), dict(gpu.palette_index), bytes(gpu.palette_used)
+
+
+def _compare_rewound(cpu, program, where):
+    expected = reference_cpu(program, cpu.cycles)
+    actual = cpu_state(cpu, cpu.cycles)
+    if actual != expected:
+        raise AssertionError(f"A/PC/zero/carry/running/cycles {_registers(actual)}, "
+                             f"expected {_registers(expected)} {where}")
+
+
+def reference_line(x1, y1, x2, y2):
+    """Points the original error-accumulator Bresenham loop wrote, before clipping"""
+    dx = abs(x2 - x1)
+    dy = abs(y2 - y1)
+    x, y = x1, y1
+    sx = 1 if x1 < x2 else -1
+    sy = 1 if y1 < y2 else -1
+    points = []
+    if dx > dy:
+        err = dx / 2.0
+        while x != x2:
+            points.append((x, y))
+            err -= dy
+            if err < 0:
+                y += sy
+                err += dx
+            x += sx
+    else:
+        err = dy / 2.0
+        while y != y2:
+            points.append((x, y))
+            err -= dx
+            if err < 0:
+                x += sx
+                err += dy
+            y += sy
+    points.append((x, y))
+    return points
+
+
+def check_line(count, seed, width=40, height=30):
+    """GPU.draw_line against the original Bresenham loop, endpoints on and off screen"""
+    import numpy as np
+    from gpu import GPU
+
+    rng = random.Random(seed)
+    gpu = GPU(width, height)
+    for _ in range(count):
+        x1, x2 = rng.randint(-10, width + 10), rng.randint(-10, width + 10)
+        y1, y2 = rng.randint(-10, height + 10), rng.randint(-10, height + 10)
+        gpu.clear_screen()
+        gpu.draw_line(x1, y1, x2, y2, 1, 2, 3)
+        expected = np.zeros_like(gpu.vram)
+        for x, y in reference_line(x1, y1, x2, y2):
+            if 0 <= x < width and 0 <= y < height:
+                expected[y, x] = (1, 2, 3)
+        if not (gpu.vram == expected).all():
+            raise AssertionError(f"draw_line({x1}, {y1}, {x2}, {y2}) differs on a {width}x{height} GPU")
+    return count
+
+
+def random_gpu_program(rng, commands):
+    """Random GPU machine code leaning on what optimize_gpu rewrites: PLOT runs, repeated
+    colours, CLEARs and GHALTs mid-stream, plus the odd PAL, BLIT, unknown or truncated command"""
+    colours = [(rng.randrange(256),) * 3 for _ in range(3)] + [(255, 255, 255), (0, 0, 0)]
+    # PAL and palette-index BLITs make optimize_gpu pass the stream through, so keep them rare
+    palette = rng.random() < 0.2
+    code = []
+    for _ in range(commands):
+        r = rng.random()
+        if r < 0.3:
+            code += [0x04]
+        elif r < 0.45:
+            code += [0x01, rng.randrange(40)]
+        elif r < 0.55:
+            code += [0x02, rng.randrange(40)]
+        elif r < 0.65:
+            code += [0x03, *rng.choice(colours)]
+        elif r < 0.72:
+            code += [0x07, rng.randrange(20), rng.randrange(20)]
+        elif r < 0.78:
+            code += [0x06, rng.randrange(60), rng.randrange(60)]
+        elif r < 0.8:
+            code += [0x05]
+        elif r < 0.82:
+            code += [0xFF]
+        elif r < 0.84:
+            code += [0x00]
+        elif r < 0.86:
+            mode = rng.choice((0x00, 0x01, 0x04, 0x05) + ((0x02, 0x06) if palette else ()))
+            code += [0x09, 0, rng.randrange(200), rng.randint(1, 8), rng.randint(1, 8),
+                     mode | rng.randrange(3) << 4]
+        elif r < 0.87 and palette:
+            code += [0x08, rng.randrange(8), *rng.choice(colours)]
+        else:
+            x = rng.randrange(50)
+            code += [0x01, x]
+            for k in range(rng.randint(1, 30)):
+                code += [0x01, x + k, 0x04]
+    if rng.random() < 0.1:
+        code += [0x0A]  # unknown opcode
+    if rng.random() < 0.1:
+        code += [0x03, 1]  # truncated
+    return bytes(code)
+
+
+def gpu_frames(code, width, height, indexed, memory):
+    """Every frame and the registers after it, or the error and VRAM it stopped with"""
+    from gpu import GPU
+
+    gpu = GPU(width, height, indexed=indexed)
+    gpu.memory = memory
+    out = []
+    try:
+        for frame in gpu.frames(code):
+            out.append((frame.tobytes(), gpu.current_x, gpu.current_y,
+                        gpu.current_r, gpu.current_g, gpu.current_b))
+    except (ValueError, IndexError) as e:
+        out += [type(e).__name__, gpu.to_rgb().tobytes()]
+    return out
+
+
+def check_gpu_optimizer(count, seed):
+    """optimize_gpu output against the original stream, frame by frame, in RGB and indexed VRAM"""
+    from optimize import optimize_gpu
+
+    rng = random.Random(seed)
+    for _ in range(count):
+        width, height = rng.choice([(640, 480), (32, 24), (300, 20)])
+        indexed = rng.random() < 0.3
+        memory = bytearray(rng.randbytes(1024))
+        code = random_gpu_program(rng, rng.randint(1, 200))
+        optimized = optimize_gpu(code, width, height)
+        if gpu_frames(code, width, height, indexed, memory) != gpu_frames(optimized, width, height, indexed, memory):
+            raise AssertionError(f"optimize_gpu changes the frames of {list(code)} on a "
+                                 f"{width}x{height}{' indexed' if indexed else ''} GPU")
+    return count
+
+
+def cosim_program(rng, fifo_base, fifo_size):
+    """Straight-line CPU code that STAs random GPU commands into the FIFO, then HALTs.
+
+    Returns the program, the number of instructions it retires and the
+    commands the GPU should receive.
+    """
+    from cosim import GPU_OPERANDS
+
+    program = []
+    commands = []
+    for _ in range(rng.randint(0, 14)):
+        opcode = rng.choice((0x01, 0x02, 0x03, 0x04, 0x05, 0x07, 0xFF))
+        command = [opcode] + [rng.randrange(256) for _ in range(GPU_OPERANDS[opcode])]
+        for byte in command:
+            if rng.random() < 0.1:
+                program += [0x00]
+            program += [0x01, byte, 0x04, fifo_base + rng.randrange(fifo_size)]
+        commands.append(command)
+    program.append(0xFF)
+    return program, len(program) - 2 * sum(map(len, commands)), commands
+
+
+def check_capture(count, seed):
+    """capture() through every writer against the frames of a plain GPU run.
+
+    The raw file must hold the frames byte for byte, every PNG must inflate
+    (chunk CRCs, filter bytes) back to its frame, and the Y4M stream must
+    have the right header, frame count and BT.601 planes to within rounding.
+    """
+    import tempfile
+
+    import numpy as np
+
+    from capture import PNGWriter, RawWriter, Y4MWriter, capture
+    from gpu import GPU
+
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as directory:
+        raw_path = os.path.join(directory, "out.raw")
+        y4m_path = os.path.join(directory, "out.y4m")
+        png_pattern = os.path.join(directory, "png", "frame_%05d.png")
+        for case in range(count):
+            width, height = rng.choice([(32, 24), (7, 5), (300, 20)])
+            indexed = rng.random() < 0.3
+            memory = bytearray(rng.randbytes(1024))
+            code = random_gpu_program(rng, rng.randint(1, 60))
+            expected = gpu_frames(code, width, height, indexed, memory)
+            error = None
+            if expected and not isinstance(expected[-1], tuple):
+                error, expected = expected[-2], expected[:-2]
+            frames = [frame for frame, *_ in expected]
+            max_frames = rng.choice((None, None, rng.randint(1, 4)))
+            if max_frames is not None and len(frames) >= max_frames:
+                frames, error = frames[:max_frames], None
+
+            gpu = GPU(width, height, indexed=indexed)
+            gpu.memory = memory
+            seen = []
+            raised = None
+            with RawWriter(raw_path) as raw, Y4MWriter(y4m_path, width, height, fps=30) as y4m:
+                png = PNGWriter(png_pattern, level=rng.choice((0, 1, 6, 9)))
+
+                class Writers:
+                    def write(self, frame):
+                        raw.write(frame)
+                        png.write(frame)
+                        y4m.write(frame)
+
+                try:
+                    produced = capture(gpu, code, Writers(), lambda i, frame: seen.append(i), max_frames)
+                except (ValueError, IndexError) as e:
+                    raised, produced = type(e).__name__, len(seen)
+            where = f"case {case}: {list(code)} on a {width}x{height}{' indexed' if indexed else ''} GPU"
+            if raised != error or produced != len(frames) or seen != list(range(len(frames))):
+                raise AssertionError(f"capture of {where}: {produced} frames ({raised}), "
+                                     f"expected {len(frames)} ({error})")
+
+            with open(raw_path, "rb") as f:
+                if f.read() != b"".join(frames):
+                    raise AssertionError(f"raw capture of {where} differs from the frames")
+
+            for index, frame in enumerate(frames):
+                with open(png_pattern % index, "rb") as f:
+                    decoded = _decode_png(f.read(), where)
+                if decoded != (width, height, frame):
+                    raise AssertionError(f"PNG frame {index} of {where} differs from the frame")
+
+            with open(y4m_path, "rb") as f:
+                data = f.read()
+            header = f"YUV4MPEG2 W{width} H{height} F30:1 Ip A1:1 C444\n".encode()
+            size = len(b"FRAME\n") + 3 * width * height
+            if not data.startswith(header) or len(data) != len(header) + size * len(frames):
+                raise AssertionError(f"Y4M capture of {where}: bad header or {len(data)} bytes "
+                                     f"for {len(frames)} frames")
+            for index, frame in enumerate(frames):
+                start = len(header) + size * index
+                if data[start:start + 6] != b"FRAME\n":
+                    raise AssertionError(f"Y4M frame {index} of {where} has no FRAME marker")
+                planes = np.frombuffer(data, np.uint8, 3 * width * height, start + 6).reshape(3, height, width)
+                r, g, b = np.frombuffer(frame, np.uint8).reshape(height, width, 3).transpose(2, 0, 1) / 255.0
+                reference = np.stack([16 + 65.481 * r + 128.553 * g + 24.966 * b,
+                                      128 - 37.797 * r - 74.203 * g + 112.0 * b,
+                                      128 + 112.0 * r - 93.786 * g - 18.214 * b])
+                off = np.abs(planes - reference).max()
+                if off > 0.501:
+                    raise AssertionError(f"Y4M frame {index} of {where} is {off:.3f} off the BT.601 conversion")
+    return count
+
+
+def _decode_png(data, where):
+    """(width, height, rgb bytes) of a PNG as written by encode_png, checking every chunk CRC"""
+    import struct
+    import zlib
+
+    if data[:8] != b"\x89PNG\r\n\x1a\n":
+        raise AssertionError(f"PNG of {where} has no signature")
+    chunks = []
+    position = 8
+    while position < len(data):
+        length, = struct.unpack_from(">I", data, position)
+        kind = data[position + 4:position + 8]
+        body = data[position + 8:position + 8 + length]
+        crc, = struct.unpack_from(">I", data, position + 8 + length)
+        if zlib.crc32(kind + body) & 0xFFFFFFFF != crc:
+            raise AssertionError(f"PNG of {where} has a bad {kind} CRC")
+        chunks.append((kind, body))
+        position += 12 + length
+    kinds = [kind for kind, _ in chunks]
+    if kinds[0] != b"IHDR" or kinds[-1] != b"IEND" or b"IDAT" not in kinds:
+        raise AssertionError(f"PNG of {where} has chunks {kinds}")
+    width, height, depth, colour, *_ = struct.unpack(">IIBBBBB", chunks[0][1])
+    if (depth, colour) != (8, 2):
+        raise AssertionError(f"PNG of {where} is not 8 bit RGB")
+    rows = zlib.decompress(b"".join(body for kind, body in chunks if kind == b"IDAT"))
+    stride = 3 * width + 1
+    if len(rows) != stride * height or any(rows[i * stride] for i in range(height)):
+        raise AssertionError(f"PNG of {where} has {len(rows)} bytes of scanlines or a filtered row")
+    return width, height, b"".join(rows[i * stride + 1:(i + 1) * stride] for i in range(height))
+
+
+def check_cosim(count, seed, width=32, height=24):
+    """Scheduler frame accounting on random FIFO-feeding programs, batched or not.
+
+    Frames must add up to the elapsed cycles, retired instructions and
+    GPU commands, one per GHALT plus at most a trailing incomplete one
+    that did some work; every CPU class must give the same frames and
+    the final picture must match the commands run straight on a GPU.
+    """
+    from cosim import FIFO_BASE, FIFO_SIZE, Scheduler
+    from gpu import GPU
+
+    rng = random.Random(seed)
+    for _ in range(count):
+        program, retired, commands = cosim_program(rng, FIFO_BASE, FIFO_SIZE)
+        options = dict(ratio=rng.choice((1, 4, 16, 64)), depth=rng.choice((6, 7, 64)),
+                       slice_cycles=rng.choice((1, 7, 256)), batch=rng.random() < 0.5)
+        reference = GPU(width, height)
+        for _ in reference.frames(bytes(sum(commands, []))):
+            pass
+        ghalts = sum(command[0] == 0xFF for command in commands)
+        seen = None
+        for make in (CPU, DecodedCPU, JITCPU):
+            cpu = make()
+            gpu = GPU(width, height)
+            cpu.load_program(program)
+            scheduler = Scheduler(cpu, gpu, **options)
+            frames = [frame.as_dict() for frame in scheduler.run()]
+            where = f"{make.__name__} on {program} with {options}"
+            if sum(frame["cycles"] for frame in frames) != scheduler.cycles:
+                raise AssertionError(f"frame cycles do not add up to {scheduler.cycles}: {where}")
+            if sum(frame["cpu_cycles"] for frame in frames) != retired:
+                raise AssertionError(f"frames retired other than {retired} instructions: {where}")
+            if sum(frame["gpu_cycles"] for frame in frames) != len(commands):
+                raise AssertionError(f"frames ran other than {len(commands)} commands: {where}")
+            complete = [frame["complete"] for frame in frames]
+            if complete[:ghalts] != [True] * ghalts or len(frames) > ghalts + 1:
+                raise AssertionError(f"{len(frames)} frames {complete} for {ghalts} GHALTs: {where}")
+            if len(frames) > ghalts and not (frames[-1]["cpu_cycles"] or frames[-1]["gpu_cycles"]):
+                raise AssertionError(f"empty trailing frame {frames[-1]}: {where}")
+            if not (gpu.vram == reference.vram).all():
+                raise AssertionError(f"final frame differs from running the commands directly: {where}")
+            if seen is not None and frames != seen:
+                raise AssertionError(f"frames differ from CPU's: {where}")
+            seen = frames
+    return count
+
+
+# (request body, HTTP status /run must answer with)
+SERVICE_REQUESTS = [
+    (b"{", 400),
+    (b"[]", 400),
+    (b'{"kind": "elf"}', 400),
+    (b'{"source": 5}', 400),
+    (b'{"source": "BOGUS"}', 400),
+    (b'{"kind": "lang", "source": "compute\\n x = 1"}', 400),
+    (b'{"kind": "image", "image": "/w=="}', 200),
+    (b'{"kind": "image", "image": "AQ"}', 400),
+    (b'{"kind": "image", "image": "AQ==!"}', 400),
+    (b'{"kind": "image", "image": "", "gpu": "not base64"}', 400),
+    (b'{"kind": "image", "image": 7}', 400),
+    (b'{"source": "HALT", "max_cycles": 0}', 400),
+    (b'{"source": "HALT", "max_cycles": -1}', 400),
+    (b'{"source": "HALT", "max_cycles": true}', 400),
+    (b'{"source": "HALT", "max_cycles": "5"}', 400),
+    (b'{"source": "HALT", "max_cycles": 1.5}', 400),
+    (b'{"source": "HALT", "time_limit": -1}', 400),
+    (b'{"source": "HALT", "time_limit": "1"}', 400),
+    (b'{"source": "HALT", "time_limit": NaN}', 400),
+    (b'{"source": "HALT", "time_limit": 0.5, "max_cycles": 99999999999}', 200),
+]
+
+
+def check_service(count, seed):
+    """Service /run validation, plus random programs against CPU.run, sent concurrently.
+
+    Every malformed request must get a 400 and leave the emulators usable;
+    every program must come back with the registers, cycles, status and
+    unknown-opcode diagnostics a plain CPU.run gives.
+    """
+    import asyncio
+    import base64
+    import json
+
+    from runner import digest
+    from service import Service, ThreadOutput
+
+    rng = random.Random(seed)
+    cases = [({"kind": "image", "image": ""}, "halted", "halt", 0)]  # no CPU code at all
+    cases.append(({"source": "loop: JMP loop", "max_cycles": 5_000_000}, "infinite-loop", "infinite-loop", 5_000_000))
+    programs = []
+    for _ in range(count):
+        program = random_program(rng)
+        max_cycles = rng.randint(1, MAX_CYCLES)
+        cpu = CPU()
+        cpu.load_program(program)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            try:
+                cpu.run(max_cycles)
+            except IndexError:
+                continue
+        programs.append((program, output.getvalue()))
+        status = "halted" if cpu.halt_reason == "halt" else cpu.halt_reason
+        request = {"kind": "image", "image": base64.b64encode(bytes(program)).decode(), "max_cycles": max_cycles}
+        cases.append((request, status, cpu.halt_reason, cpu.cycles,
+                       cpu.A, cpu.PC, cpu.zero_flag, cpu.carry_flag, digest(cpu.memory), output.getvalue()))
+
+    async def run(service):
+        for body, expected in SERVICE_REQUESTS:
+            status, payload = await service.dispatch("POST", "/run", body)
+            if status != expected:
+                raise AssertionError(f"/run answered {status} {payload} to {body!r}, expected {expected}")
+        for start in range(0, len(cases), 16):
+            batch = cases[start:start + 16]
+            answers = await asyncio.gather(*(service.dispatch("POST", "/run", json.dumps(case[0]).encode())
+                                             for case in batch))
+            for case, (status, result) in zip(batch, answers):
+                if status != 200:
+                    raise AssertionError(f"/run answered {status} {result} to {case[0]}")
+                actual = (result["status"], result["halt_reason"], result["cycles"])
+                if len(case) > 4:
+                    actual += (result["A"], result["PC"], result["zero_flag"], result["carry_flag"],
+                               result["memory_digest"], result["diagnostics"])
+                if actual != case[1:]:
+                    raise AssertionError(f"/run differs from CPU.run on {case[0]}: {actual}, expected {case[1:]}")
+
+    service = Service(pool_size=4, max_queue=len(cases))
+    try:
+        with contextlib.redirect_stdout(ThreadOutput(sys.stdout)):  # as under serve
+            asyncio.run(run(service))
+    finally:
+        service.close()
+    return len(SERVICE_REQUESTS) + len(cases)
+
+
+# name -> check(count, seed) returning the number of cases compared
+CHECKS = {
+    "batch": check_batch,
+    "capture": check_capture,
+    "cosim": check_cosim,
+    "cpu": check_cpu,
+    "gpu-optimizer": check_gpu_optimizer,
+    "jit": check_jit,
+    "line": check_line,
+    "profiler": check_profiler,
+    "service": check_service,
+    "snapshot": check_snapshot,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Differential checks of the fast paths against reference implementations")
+    parser.add_argument("check", choices=sorted(CHECKS) + ["all"])
+    parser.add_argument("--count", type=int, default=2000, help="random cases per check")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    failed = False
+    for name in sorted(CHECKS) if args.check == "all" else [args.check]:
+        try:
+            checked = CHECKS[name](args.count, args.seed)
+        except AssertionError as e:
+            print(f"{name}: MISMATCH {e}")
+            failed = True
+        else:
+            print(f"{name}: {checked} cases match")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
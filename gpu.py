@@ -1,12 +1,125 @@
-import pygame
+import threading
+from collections import OrderedDict
+
 import numpy as np
 
+MAX_DIRTY_RECTS = 64  # beyond this, dirty rects collapse into one bounding box
+PALETTE_SIZE = 256    # entries in the indexed-mode palette
+SPRITE_STORE_SIZE = 1 << 16  # bytes of GPU-side sprite memory, BLIT addresses are 16 bit
+SPRITE_CACHE_SIZE = 256      # decoded sprites kept, shared by every GPU
+
+# BLIT mode byte: flag bits, integer scale - 1 in the high nibble
+BLIT_SPRITES = 0x01      # read from gpu.sprites instead of CPU memory
+BLIT_INDICES = 0x02      # bytes are palette indices instead of RGB332
+BLIT_TRANSPARENT = 0x04  # zero bytes are left undrawn
+
+# RGB332 byte -> (r, g, b)
+_levels = np.arange(256)
+RGB332 = np.stack([(_levels >> 5) * 255 // 7, (_levels >> 2 & 7) * 255 // 7,
+                   (_levels & 3) * 255 // 3], axis=1).astype(np.uint8)
+del _levels
+
+# (bytes, width, height, scale, mode, indexed) -> (pixels, opaque mask), least
+# recently used dropped first; locked since GPUs may draw on several threads
+_SPRITE_CACHE = OrderedDict()
+_SPRITE_CACHE_LOCK = threading.Lock()
+
+# 640x480@60 VGA timing in pixels / lines; visible size comes from the GPU
+H_FRONT_PORCH, H_SYNC, H_BACK_PORCH = 16, 96, 48
+V_FRONT_PORCH, V_SYNC, V_BACK_PORCH = 10, 2, 33
+
+
+class VGAFrame:
+    """VGA signal for a run of scanlines, as (lines, pixels per line) arrays.
+
+    hsync/vsync are the negative-polarity sync levels (0.0 during the
+    pulse, 1.0 otherwise) and r/g/b the normalised colour, 0.0 during
+    blanking. start is the index of the first scanline.
+    """
+
+    __slots__ = ("start", "hsync", "vsync", "r", "g", "b")
+
+    def __init__(self, start, hsync, vsync, r, g, b):
+        self.start = start
+        self.hsync = hsync
+        self.vsync = vsync
+        self.r = r
+        self.g = g
+        self.b = b
+
+
+def sync_levels(visible, front_porch, sync, back_porch):
+    """One line (or one frame column) of negative-polarity sync levels"""
+    levels = np.ones(visible + front_porch + sync + back_porch, dtype=np.float32)
+    levels[visible + front_porch:visible + front_porch + sync] = 0.0
+    return levels
+
+
+def decode_vga(frame):
+    """Rebuild VRAM from a full VGAFrame by locking onto its sync pulses"""
+    columns = _visible_span(frame.hsync[0], H_BACK_PORCH, H_FRONT_PORCH + H_SYNC + H_BACK_PORCH)
+    rows = _visible_span(frame.vsync[:, 0], V_BACK_PORCH, V_FRONT_PORCH + V_SYNC + V_BACK_PORCH)
+    index = np.ix_(rows, columns)
+    rgb = np.stack([frame.r[index], frame.g[index], frame.b[index]], axis=-1)
+    return np.rint(rgb * 255).astype(np.uint8)
+
+
+def _visible_span(levels, back_porch, blanking):
+    """Indices of the visible part of a sync signal: back_porch after the pulse ends"""
+    total = len(levels)
+    low = levels < 0.5
+    last_low = np.flatnonzero(low & ~np.roll(low, -1))[0]  # circular, so any phase works
+    start = (last_low + 1 + back_porch) % total
+    return (start + np.arange(total - blanking)) % total
+
+
+def _add_rect(dirty, x, y, w, h, width, height):
+    """Merge a rect into a dirty list; returns the list, which may be a new one"""
+    if dirty:
+        lx, ly, lw, lh = dirty[-1]
+        # Extend the previous rect when it is the same row span, so runs of
+        # PLOTs along a scanline stay a single rect
+        if ly == y and lh == h and lx + lw == x:
+            dirty[-1] = (lx, ly, lw + w, lh)
+            return dirty
+        if lx <= x and ly <= y and x + w <= lx + lw and y + h <= ly + lh:
+            return dirty
+    if w == width and h == height:
+        return [(0, 0, w, h)]
+    dirty.append((x, y, w, h))
+    if len(dirty) > MAX_DIRTY_RECTS:
+        x0 = min(r[0] for r in dirty)
+        y0 = min(r[1] for r in dirty)
+        x1 = max(r[0] + r[2] for r in dirty)
+        y1 = max(r[1] + r[3] for r in dirty)
+        return [(x0, y0, x1 - x0, y1 - y0)]
+    return dirty
+
+
 class GPU:
-    def __init__(self, width=640, height=480):
+    """GPU with 24-bit RGB VRAM, or one byte of palette index per pixel when indexed.
+
+    In indexed mode each pixel is one byte naming a palette entry. SETC
+    keeps taking r g b: the first draw in a colour picks the entry PAL
+    loaded with it, or claims the lowest entry not yet in use. VRAM is
+    only expanded to RGB when it is presented, so PAL changes the
+    colour of every pixel using that entry without touching VRAM.
+    """
+
+    def __init__(self, width=640, height=480, indexed=False):
         self.width = width
         self.height = height
-        self.memory_size = width * height * 3
-        self.vram = [0] * self.memory_size
+        self.indexed = indexed
+        if indexed:
+            self.memory_size = width * height
+            self.vram = np.zeros((height, width), dtype=np.uint8)
+        else:
+            self.memory_size = width * height * 3
+            self.vram = np.zeros((height, width, 3), dtype=np.uint8)
+        self.palette = np.zeros((PALETTE_SIZE, 3), dtype=np.uint8)
+        self.reset_palette()
+        self.sprites = bytearray(SPRITE_STORE_SIZE)
+        self.memory = None  # CPU memory BLIT reads from, e.g. gpu.memory = cpu.memory
         
         self.hsync = 0.0
         self.vsync = 0.0
@@ -15,13 +128,13 @@ class GPU:
         self.b_signal = 0.0
         self.current_x = 0
         self.current_y = 0
-        
-        self.surface = pygame.Surface((width, height))
+        self.dirty = []  # (x, y, w, h) regions changed since the last take_dirty_rects
+        self.vram_version = 0  # bumped by mark_dirty on every VRAM change
+        self._vga = None
 
-    def load_program(self, program):
-        """Load and execute a program into the GPU"""
         self.PC = 0
-        self.program = program
+        self.program = []
+        self.running = False
         self.instructions = {
             0x00: self.nop,     # No operation
             0x01: self.setx,    # Set X coordinate
@@ -31,14 +144,61 @@ class GPU:
             0x05: self.clear,   # Clear screen
             0x06: self.line,    # Draw line
             0x07: self.rect,    # Draw rectangle
+            0x08: self.pal,     # Load palette entry
+            0x09: self.blit,    # Copy a bitmap into VRAM
             0xFF: self.halt     # Halt GPU
         }
+        self.reset_state()
+        
+        self._surface = None  # pygame.Surface, created on first use
+        self._surface_dirty = []  # like dirty, but since the last upload into _surface
+        self.presenter = None  # present.Presenter fed at every GHALT / swap()
+
+    def load_program(self, program, profiler=None):
+        """Load and execute a program into the GPU"""
+        self.program = program
+        self.run(profiler)
+
+    def reset(self):
+        """Return to power-on state: black VRAM, empty program, registers and palette reset"""
+        self.vram.fill(0)
+        self.mark_dirty(0, 0, self.width, self.height)
+        self.program = []
+        self.running = False
+        self.reset_state()
+        self.reset_palette()
+        self.sprites[:] = bytes(SPRITE_STORE_SIZE)
 
+    def reset_palette(self):
+        """Palette back to a single black entry 0, every other entry free"""
+        self.palette.fill(0)
+        self.palette_index = {(0, 0, 0): 0}  # (r, g, b) -> entry drawn with for that colour
+        self.palette_used = bytearray(PALETTE_SIZE)
+        self.palette_used[0] = 1
+        # RGB332 byte -> palette entry for indexed BLITs, and which bytes are resolved so far
+        self._rgb332_lookup = np.zeros(256, dtype=np.uint8)
+        self._rgb332_known = np.zeros(256, dtype=bool)
+
+    def reset_state(self):
+        """Rewind PC and reset the cursor and colour registers"""
+        self.PC = 0
         self.current_x = 0
         self.current_y = 0
         self.current_r = 255
         self.current_g = 255
         self.current_b = 255
+
+    def run(self, profiler=None):
+        """Run the loaded program from the start until GHALT"""
+        self.reset_state()
+        if profiler is not None:
+            profiler.run_gpu(self)
+        else:
+            self.execute()
+
+    def execute(self):
+        """Dispatch instructions from the current PC until GHALT or the end of the program"""
+        program = self.program
         self.running = True
 
         while self.running and self.PC < len(program):
@@ -47,7 +207,48 @@ class GPU:
                 self.instructions[instruction]()
             else:
                 raise ValueError(f"Unknown GPU instruction: {hex(instruction)}")
-            
+
+    def frames(self, program=None):
+        """Run a program headlessly, yielding the RGB frame each time one is finished.
+
+        Every GHALT ends a frame and execution carries on with the next
+        instruction; the end of the program ends the last one. The yielded
+        array is VRAM itself, so copy it if it must outlive the next frame.
+        """
+        if program is not None:
+            self.program = program
+        self.reset_state()
+        while self.PC < len(self.program):
+            self.execute()
+            yield self.to_rgb()
+
+    @property
+    def surface(self):
+        """pygame.Surface mirroring VRAM; pygame is only imported here on first use"""
+        if self._surface is None:
+            import pygame
+            self._surface = pygame.Surface((self.width, self.height))
+            self._surface_dirty = [(0, 0, self.width, self.height)]
+        return self._surface
+
+    def display(self):
+        """Show the current frame in a pygame window until it is closed"""
+        import pygame
+        pygame.init()
+        screen = pygame.display.set_mode((self.width, self.height))
+        pygame.display.set_caption("GPU")
+        screen.blit(self.get_pygame_surface(), (0, 0))
+        pygame.display.flip()
+
+        clock = pygame.time.Clock()
+        while not any(event.type == pygame.QUIT for event in pygame.event.get()):
+            rects = self.update_surface()
+            for x, y, w, h in rects:
+                screen.blit(self.surface, (x, y), (x, y, w, h))
+            pygame.display.update(rects)
+            clock.tick(60)
+        pygame.quit()
+
     def nop(self):
         """No operation"""
         self.PC += 1
@@ -76,64 +277,129 @@ class GPU:
     
     def clear(self):
         """Clear VRAM"""
-        self.vram = [0] * (self.width * self.height) * 3
+        self.vram.fill(0)
+        self.mark_dirty(0, 0, self.width, self.height)
+        self.PC += 1
 
     def line(self):
-        """Draw line"""
-        self.PC += 1
+        """Draw line from current (X,Y) to (x2,y2): LINE x2 y2"""
+        x2 = self.program[self.PC + 1] % self.width
+        y2 = self.program[self.PC + 2] % self.height
+        self.draw_line(self.current_x, self.current_y, x2, y2,
+                       self.current_r, self.current_g, self.current_b)
+        self.PC += 3
     
     def rect(self):
-        """Draw rectangle"""
-        self.PC += 1
+        """Draw filled rectangle at current (X,Y): RECT width height"""
+        width = self.program[self.PC + 1]
+        height = self.program[self.PC + 2]
+        self.draw_rectangle(self.current_x, self.current_y, width, height,
+                            self.current_r, self.current_g, self.current_b)
+        self.PC += 3
     
+    def pal(self):
+        """Load palette entry: PAL index r g b"""
+        program = self.program
+        pc = self.PC
+        self.load_palette(program[pc + 1], program[pc + 2], program[pc + 3], program[pc + 4])
+        self.PC += 5
+
+    def blit(self):
+        """Copy a bitmap to current (X,Y): BLIT address_hi address_lo width height mode"""
+        program = self.program
+        pc = self.PC
+        self.draw_bitmap(self.current_x, self.current_y, program[pc + 1] << 8 | program[pc + 2],
+                         program[pc + 3], program[pc + 4], program[pc + 5])
+        self.PC += 6
+
     def halt(self):
-        """Halt"""
+        """Halt, committing the finished frame to the presenter if there is one"""
         self.PC += 1
         self.running = False
+        if self.presenter is not None:
+            self.presenter.commit()
+
+    def swap(self):
+        """Commit VRAM as a finished frame without halting"""
+        if self.presenter is not None:
+            self.presenter.commit()
+
+    def load_palette(self, index, r, g, b):
+        """Set palette entry index; in indexed mode every pixel using it changes colour"""
+        index &= 0xFF
+        colour = (r & 0xFF, g & 0xFF, b & 0xFF)
+        old = tuple(self.palette[index].tolist())
+        if self.palette_index.get(old) == index:
+            del self.palette_index[old]
+        self.palette[index] = colour
+        self.palette_index[colour] = index
+        self.palette_used[index] = 1
+        self._rgb332_known.fill(False)  # colours may now map to other entries
+        if self.indexed:
+            self.mark_dirty(0, 0, self.width, self.height)
+
+    def pixel_value(self, r, g, b):
+        """What VRAM stores for a colour: (r, g, b), or its palette entry in indexed mode"""
+        colour = (r & 0xFF, g & 0xFF, b & 0xFF)
+        if not self.indexed:
+            return colour
+        index = self.palette_index.get(colour)
+        if index is None:
+            index = self.palette_used.find(0)
+            if index < 0:
+                raise ValueError(f"Palette full: no entry left for colour {colour}")
+            self.palette[index] = colour
+            self.palette_index[colour] = index
+            self.palette_used[index] = 1
+        return index
+
+    def to_rgb(self, pixels=None):
+        """VRAM (or a slice of it) as RGB: as is, or expanded through the palette in one lookup"""
+        if pixels is None:
+            pixels = self.vram
+        if not self.indexed:
+            return pixels
+        return self.palette.take(pixels, axis=0)
 
     def write_pixel(self, x, y, r, g, b):
         """Write a pixel to VRAM"""
         if 0 <= x < self.width and 0 <= y < self.height:
-            base_index = (y * self.width + x) * 3
-            self.vram[base_index] = r & 0xFF
-            self.vram[base_index + 1] = g & 0xFF
-            self.vram[base_index + 2] = b & 0xFF
+            self.vram[y, x] = self.pixel_value(r, g, b)
+            self.mark_dirty(x, y, 1, 1)
 
     def read_pixel(self, x, y):
-        """Read a pixel from VRAM"""
+        """Read a pixel from VRAM as (r, g, b)"""
         if 0 <= x < self.width and 0 <= y < self.height:
-            base_index = (y * self.width + x) * 3
-            return (
-                self.vram[base_index],
-                self.vram[base_index + 1],
-                self.vram[base_index + 2]
-            )
+            pixel = self.vram[y, x]
+            if self.indexed:
+                pixel = self.palette[pixel]
+            r, g, b = pixel.tolist()
+            return (r, g, b)
         return (0, 0, 0)
 
     def clear_screen(self, r=0, g=0, b=0):
         """Clear the screen with a specific color"""
-        for i in range(0, self.memory_size, 3):
-            self.vram[i] = r & 0xFF
-            self.vram[i + 1] = g & 0xFF
-            self.vram[i + 2] = b & 0xFF
+        self.vram[:] = self.pixel_value(r, g, b)
+        self.mark_dirty(0, 0, self.width, self.height)
 
     def simulate_vga_signals(self):
-        """Simulate VGA signal generation"""
+        """Sample the VGA signal at the current (X,Y) and step the beam there.
+
+        A view over vga_frame(), so repeated calls within one VRAM version
+        only index the cached frame.
+        """
         x = self.current_x
         y = self.current_y
+        self.vga_frame()
+        _, _, hsync, vsync, rgb = self._vga
 
-        self.hsync = 1.0 if x < self.width else 0.0
-        self.vsync = 1.0 if y < self.height else 0.0
-
-        if 0 <= x < self.width and 0 <= y < self.height:
-            pixel = self.read_pixel(x, y)
-            self.r_signal = pixel[0] / 255.0
-            self.g_signal = pixel[1] / 255.0
-            self.b_signal = pixel[2] / 255.0
+        if 0 <= x < len(hsync) and 0 <= y < len(vsync):
+            self.hsync = hsync[x]
+            self.vsync = vsync[y]
+            self.r_signal, self.g_signal, self.b_signal = rgb[:, y, x].tolist()
         else:
-            self.r_signal = 0.0
-            self.g_signal = 0.0
-            self.b_signal = 0.0
+            self.hsync = self.vsync = 0.0
+            self.r_signal = self.g_signal = self.b_signal = 0.0
 
         self.current_x += 1
         if self.current_x >= self.width:
@@ -142,49 +408,205 @@ class GPU:
             if self.current_y >= self.height:
                 self.current_y = 0
 
+    def vga_frame(self):
+        """The whole VGA frame for current VRAM, blanking intervals included.
+
+        Cached until VRAM changes (tracked through mark_dirty); the arrays
+        are read-only since every caller shares them.
+        """
+        if self._vga is None or self._vga[0] != self.vram_version:
+            frame = self._vga_lines(0, self.height + V_FRONT_PORCH + V_SYNC + V_BACK_PORCH)
+            rgb = frame.r.base  # the (3, lines, pixels) array r/g/b are planes of
+            for array in (rgb, frame.r, frame.g, frame.b):
+                array.flags.writeable = False
+            # Plain lists of the sync levels keep per-pixel sampling cheap
+            self._vga = (self.vram_version, frame,
+                         frame.hsync[0].tolist(), frame.vsync[:, 0].tolist(), rgb)
+        return self._vga[1]
+
+    def vga_scanlines(self, lines=32):
+        """Yield the VGA frame as VGAFrame chunks of up to lines scanlines"""
+        total = self.height + V_FRONT_PORCH + V_SYNC + V_BACK_PORCH
+        for start in range(0, total, lines):
+            yield self._vga_lines(start, min(start + lines, total))
+
+    def _vga_lines(self, start, stop):
+        hsync = sync_levels(self.width, H_FRONT_PORCH, H_SYNC, H_BACK_PORCH)
+        vsync = sync_levels(self.height, V_FRONT_PORCH, V_SYNC, V_BACK_PORCH)[start:stop]
+        shape = (stop - start, len(hsync))
+
+        rgb = np.zeros((3,) + shape, dtype=np.float32)
+        visible = max(min(stop, self.height) - start, 0)
+        if visible:
+            pixels = self.to_rgb(self.vram[start:start + visible]).transpose(2, 0, 1)
+            np.multiply(pixels, np.float32(1 / 255), out=rgb[:, :visible, :self.width])
+        return VGAFrame(start, np.broadcast_to(hsync, shape),
+                        np.broadcast_to(vsync[:, None], shape), rgb[0], rgb[1], rgb[2])
+
     def get_pygame_surface(self):
-        """Convert VRAM content to a Pygame surface"""
-        pixels = np.zeros((self.height, self.width, 3), dtype=np.uint8)
-        
-        for y in range(self.height):
-            for x in range(self.width):
-                pixel = self.read_pixel(x, y)
-                pixels[y, x] = pixel
+        """Blit VRAM into self.surface and return it"""
+        import pygame
+        # surfarray indexes pixels as [x, y], so hand it a transposed view
+        pygame.surfarray.blit_array(self.surface, self.to_rgb().transpose(1, 0, 2))
+        self._surface_dirty = []
+        return self.surface
+
+    def mark_dirty(self, x, y, w, h):
+        """Record that VRAM changed inside the (already clipped) rect"""
+        self.vram_version += 1
+        if self._surface is not None:
+            self._surface_dirty = _add_rect(self._surface_dirty, x, y, w, h, self.width, self.height)
+        dirty = self.dirty
+        if dirty:
+            lx, ly, lw, lh = dirty[-1]
+            # Extend the previous rect when it is the same row span, so runs of
+            # PLOTs along a scanline stay a single rect
+            if ly == y and lh == h and lx + lw == x:
+                dirty[-1] = (lx, ly, lw + w, lh)
+                return
+        self.dirty = _add_rect(dirty, x, y, w, h, self.width, self.height)
+
+    def take_dirty_rects(self):
+        """Return and reset the list of (x, y, w, h) rects changed since the last call"""
+        rects = self.dirty
+        self.dirty = []
+        return rects
+
+    def update_surface(self):
+        """Upload only the regions changed since the last upload into self.surface.
 
-        pygame_surface = pygame.surfarray.make_surface(pixels)
-        return pygame_surface
+        Returns the updated (x, y, w, h) rects, ready for
+        pygame.display.update(rects). The surface keeps its own dirty
+        list, so take_dirty_rects callers still see every change.
+        """
+        if self._surface is None:
+            # A brand new surface has none of VRAM yet, so upload all of it
+            self.get_pygame_surface()
+            return [(0, 0, self.width, self.height)]
+
+        import pygame
+        rects = self._surface_dirty
+        self._surface_dirty = []
+        if rects:
+            pixels = pygame.surfarray.pixels3d(self.surface)
+            for x, y, w, h in rects:
+                pixels[x:x + w, y:y + h] = self.to_rgb(self.vram[y:y + h, x:x + w]).transpose(1, 0, 2)
+            del pixels  # unlock the surface
+        return rects
 
     def draw_rectangle(self, x, y, width, height, r, g, b):
         """Draw a filled rectangle"""
-        for dy in range(height):
-            for dx in range(width):
-                self.write_pixel(x + dx, y + dy, r, g, b)
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, self.width), min(y + height, self.height)
+        if x0 < x1 and y0 < y1:
+            self.vram[y0:y1, x0:x1] = self.pixel_value(r, g, b)
+            self.mark_dirty(x0, y0, x1 - x0, y1 - y0)
+
+    def load_sprites(self, data, address=0):
+        """Copy bitmap bytes into the sprite store at address"""
+        if address + len(data) > len(self.sprites):
+            raise ValueError("Sprite data does not fit in the sprite store")
+        self.sprites[address:address + len(data)] = data
+
+    def draw_bitmap(self, x, y, address, width, height, mode=0):
+        """Draw a width x height bitmap read row by row from address, as one array copy.
+
+        The source is CPU memory, or the sprite store with BLIT_SPRITES;
+        each byte is an RGB332 colour, or a palette index with
+        BLIT_INDICES. BLIT_TRANSPARENT skips zero bytes and the high
+        nibble of mode scales every pixel up to 16x16.
+        """
+        source = self.sprites if mode & BLIT_SPRITES else self.memory
+        if source is None:
+            raise ValueError("BLIT from CPU memory, but the GPU has no CPU memory attached")
+        if address + width * height > len(source):
+            raise ValueError(f"BLIT source {address:#x}+{width}x{height} is out of range")
+        scale = (mode >> 4) + 1
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width * scale, self.width), min(y + height * scale, self.height)
+        if not (x0 < x1 and y0 < y1):
+            return
+
+        pixels, opaque = self._decode_sprite(bytes(source[address:address + width * height]),
+                                             width, height, scale, mode)
+        crop = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+        mask = opaque[crop] if mode & BLIT_TRANSPARENT else None
+        pixels = self._sprite_colours(pixels[crop], mask, mode & BLIT_INDICES)
+        target = self.vram[y0:y1, x0:x1]
+        if mask is not None:
+            np.copyto(target, pixels, where=mask if mask.ndim == target.ndim else mask[..., None])
+        else:
+            target[...] = pixels
+        self.mark_dirty(x0, y0, x1 - x0, y1 - y0)
+
+    def _decode_sprite(self, data, width, height, scale, mode):
+        """(pixels, opaque mask) for bitmap bytes, decoded once per content.
+
+        Pixels are RGB in RGB VRAM for RGB332 bytes, otherwise the bytes
+        themselves; _sprite_colours finishes them once cropped.
+        """
+        indices = bool(mode & BLIT_INDICES)
+        key = (data, width, height, scale, indices, self.indexed)
+        with _SPRITE_CACHE_LOCK:
+            sprite = _SPRITE_CACHE.get(key)
+            if sprite is not None:
+                _SPRITE_CACHE.move_to_end(key)
+        if sprite is None:
+            raw = np.frombuffer(data, dtype=np.uint8).reshape(height, width)
+            if scale > 1:
+                raw = raw.repeat(scale, axis=0).repeat(scale, axis=1)
+            # RGB332 has a fixed meaning in RGB VRAM; everything else depends on the palette
+            pixels = raw if indices or self.indexed else RGB332.take(raw, axis=0)
+            sprite = (pixels, raw != 0)
+            for array in sprite:
+                array.flags.writeable = False
+            with _SPRITE_CACHE_LOCK:
+                _SPRITE_CACHE[key] = sprite
+                if len(_SPRITE_CACHE) > SPRITE_CACHE_SIZE:
+                    _SPRITE_CACHE.popitem(last=False)
+
+        return sprite
+
+    def _sprite_colours(self, pixels, mask, indices):
+        """Cropped sprite pixels in VRAM format.
+
+        Palette indices become RGB in RGB VRAM through the current palette.
+        RGB332 bytes in indexed VRAM go through a lookup kept until the
+        palette changes, and only bytes that are drawn (on screen, and
+        opaque under mask) take palette entries.
+        """
+        if indices:
+            return pixels if self.indexed else self.palette.take(pixels, axis=0)
+        if not self.indexed:
+            return pixels
+        lookup, known = self._rgb332_lookup, self._rgb332_known
+        drawn = np.zeros(256, dtype=bool)
+        drawn[pixels if mask is None else pixels[mask]] = True
+        for value in np.flatnonzero(drawn & ~known).tolist():
+            lookup[value] = self.pixel_value(*RGB332[value].tolist())
+            known[value] = True
+        return lookup.take(pixels)
 
     def draw_line(self, x1, y1, x2, y2, r, g, b):
-        """Draw a line using Bresenham's algorithm"""
+        """Draw a line using integer Bresenham, rasterized in one array pass"""
         dx = abs(x2 - x1)
         dy = abs(y2 - y1)
-        x, y = x1, y1
         sx = 1 if x1 < x2 else -1
         sy = 1 if y1 < y2 else -1
-        
+        steps = np.arange(max(dx, dy) + 1)
+
+        # Closed form of the error-accumulator loop: after k major-axis steps
+        # the minor axis has moved ceil((k * minor - major / 2) / major).
         if dx > dy:
-            err = dx / 2.0
-            while x != x2:
-                self.write_pixel(x, y, r, g, b)
-                err -= dy
-                if err < 0:
-                    y += sy
-                    err += dx
-                x += sx
+            xs = x1 + sx * steps
+            ys = y1 + sy * ((2 * steps * dy + dx - 1) // (2 * dx))
         else:
-            err = dy / 2.0
-            while y != y2:
-                self.write_pixel(x, y, r, g, b)
-                err -= dx
-                if err < 0:
-                    x += sx
-                    err += dy
-                y += sy
-        
-        self.write_pixel(x, y, r, g, b)
\ No newline at end of file
+            ys = y1 + sy * steps
+            xs = x1 + sx * ((2 * steps * dx + max(dy - 1, 0)) // max(2 * dy, 1))
+
+        visible = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        xs, ys = xs[visible], ys[visible]
+        if xs.size:
+            self.vram[ys, xs] = self.pixel_value(r, g, b)
+            x0, y0 = int(xs.min()), int(ys.min())
+            self.mark_dirty(x0, y0, int(xs.max()) + 1 - x0, int(ys.max()) + 1 - y0)
@@ -0,0 +1,180 @@
+import json
+import time
+from collections import Counter, deque
+
+from archi import OPERAND_OPCODES
+from assembler import Assembler
+
+_assembler = Assembler()
+CPU_NAMES = {opcode: name for name, opcode in _assembler.cpu_instructions.items()}
+GPU_NAMES = {opcode: name for name, opcode in _assembler.gpu_instructions.items()}
+
+
+def opcode_name(unit, opcode):
+    names = CPU_NAMES if unit == "cpu" else GPU_NAMES
+    return names.get(opcode, f"0x{opcode:02x}")
+
+
+class Profiler:
+    """Counters and an optional instruction trace for CPU and GPU runs.
+
+    Pass one to CPU.run(profiler=...) or GPU.load_program(..., profiler=...)
+    and execution goes through the instrumented loops below instead of the
+    normal interpreters, which carry no instrumentation at all. Collected:
+
+    - opcode_counts / pc_hits:   Counter keyed by (unit, opcode) / (unit, pc)
+    - time_ns:                   Counter of handler wall time by (unit, pc, opcode)
+    - memory_reads / writes:     per-address CPU memory access counts
+    - trace:                     ring buffer of the last trace_size instructions
+    """
+
+    def __init__(self, trace_size=0):
+        self.opcode_counts = Counter()
+        self.pc_hits = Counter()
+        self.time_ns = Counter()
+        self.memory_reads = []
+        self.memory_writes = []
+        self.trace = deque(maxlen=trace_size) if trace_size else None
+        self.cycles = 0
+
+    def run_cpu(self, cpu, max_cycles=None):
+        """Instrumented equivalent of CPU.run; returns the cycles executed.
+
+        Sets halt_reason like CPU.resume, but does not look for endless
+        loops: a profiled run executes every instruction it is given.
+        """
+        if max_cycles is not None and max_cycles < 0:
+            raise ValueError(f"max_cycles must be non-negative, got {max_cycles}")
+        memory = cpu.memory
+        if len(self.memory_reads) < len(memory):
+            grow = len(memory) - len(self.memory_reads)
+            self.memory_reads.extend([0] * grow)
+            self.memory_writes.extend([0] * grow)
+        reads = self.memory_reads
+        writes = self.memory_writes
+        counts = self.opcode_counts
+        hits = self.pc_hits
+        time_ns = self.time_ns
+        trace = self.trace
+        clock = time.perf_counter_ns
+
+        cpu.running = True
+        cpu.halt_reason = None
+        cpu._since_check = 0
+        cpu.PC = 0
+        executed = 0
+        while cpu.running and (max_cycles is None or executed < max_cycles):
+            pc = cpu.PC
+            opcode = memory[pc]
+            reads[pc] += 1
+            if opcode in OPERAND_OPCODES:
+                reads[pc + 1] += 1
+                if opcode == 0x04:
+                    writes[memory[pc + 1]] += 1
+            cpu.PC = pc + 1
+
+            start = clock()
+            cpu.execute(opcode)
+            time_ns["cpu", pc, opcode] += clock() - start
+
+            counts["cpu", opcode] += 1
+            hits["cpu", pc] += 1
+            executed += 1
+            if trace is not None:
+                trace.append(("cpu", self.cycles + executed, pc, opcode,
+                              cpu.A, cpu.zero_flag, cpu.carry_flag))
+
+        self.cycles += executed
+        cpu.cycles = executed
+        if cpu.running:
+            cpu.halt_reason = 'cycle-limit'
+        else:
+            cpu.halt_reason = 'halt' if memory[cpu.PC - 1] == 0xFF else 'unknown-instruction'
+        # The reference handlers wrote memory behind any decoded code
+        cpu.invalidate()
+        return executed
+
+    def run_gpu(self, gpu):
+        """Instrumented equivalent of GPU.execute"""
+        program = gpu.program
+        counts = self.opcode_counts
+        hits = self.pc_hits
+        time_ns = self.time_ns
+        trace = self.trace
+        clock = time.perf_counter_ns
+
+        gpu.running = True
+        while gpu.running and gpu.PC < len(program):
+            pc = gpu.PC
+            opcode = program[pc]
+            handler = gpu.instructions.get(opcode)
+            if handler is None:
+                raise ValueError(f"Unknown GPU instruction: {hex(opcode)}")
+
+            start = clock()
+            handler()
+            time_ns["gpu", pc, opcode] += clock() - start
+
+            counts["gpu", opcode] += 1
+            hits["gpu", pc] += 1
+            self.cycles += 1
+            if trace is not None:
+                trace.append(("gpu", self.cycles, pc, opcode,
+                              gpu.current_x, gpu.current_y,
+                              (gpu.current_r, gpu.current_g, gpu.current_b)))
+
+    def opcode_time_ns(self):
+        """Total handler wall time per (unit, opcode)"""
+        totals = Counter()
+        for (unit, _, opcode), ns in self.time_ns.items():
+            totals[unit, opcode] += ns
+        return totals
+
+    def as_dict(self):
+        """JSON-friendly copy of everything collected"""
+        opcode_time = self.opcode_time_ns()
+        return {
+            "cycles": self.cycles,
+            "opcodes": [
+                {"unit": unit, "opcode": opcode_name(unit, opcode), "count": count,
+                 "time_ns": opcode_time[unit, opcode]}
+                for (unit, opcode), count in self.opcode_counts.most_common()
+            ],
+            "pc_hits": [
+                {"unit": unit, "pc": pc, "count": count}
+                for (unit, pc), count in self.pc_hits.most_common()
+            ],
+            "memory_reads": self.memory_reads,
+            "memory_writes": self.memory_writes,
+            "trace": list(self.trace) if self.trace is not None else [],
+        }
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.as_dict(), f)
+
+    def report(self, top=10):
+        """Human-readable summary of the hottest opcodes, PCs and addresses"""
+        opcode_time = self.opcode_time_ns()
+        total_ns = sum(opcode_time.values()) or 1
+        lines = [f"{self.cycles} instructions", "", "opcode         count      time   share"]
+        for (unit, opcode), count in self.opcode_counts.most_common():
+            ns = opcode_time[unit, opcode]
+            lines.append(f"{unit}:{opcode_name(unit, opcode):<10}{count:>10}"
+                         f"{ns / 1e6:>8.2f}ms{100 * ns / total_ns:>7.1f}%")
+
+        lines += ["", "hottest pcs"]
+        for (unit, pc), count in self.pc_hits.most_common(top):
+            lines.append(f"{unit}:0x{pc:04x}{count:>12}")
+
+        for title, heat in (("most read", self.memory_reads), ("most written", self.memory_writes)):
+            hottest = sorted((n, address) for address, n in enumerate(heat) if n)[::-1][:top]
+            lines += ["", title + " addresses"]
+            lines += [f"0x{address:04x}{n:>12}" for n, address in hottest]
+        return "\n".join(lines)
+
+    def write_folded(self, path):
+        """Write wall time as folded stacks (unit;pc;opcode ns) for flamegraph.pl / speedscope"""
+        with open(path, "w") as f:
+            for (unit, pc, opcode), ns in sorted(self.time_ns.items()):
+                f.write(f"{unit};0x{pc:04x};{opcode_name(unit, opcode)} {ns}\n")
@@ -2,6 +2,7 @@ from enum import Enum
 import re
 
 import assembler
+from optimize import eliminate_dead_stores, fold_constants, optimize_gpu_ir, peephole
 
 class TokenType(Enum):
     NUMBER = "NUMBER"
@@ -11,147 +12,285 @@ class TokenType(Enum):
     NEWLINE = "NEWLINE"
     EOF = "EOF"
 
-class Token:
-    def __init__(self, type, value):
-        self.type = type
-        self.value = value
+# Variables are laid out downwards from just below cosim.FIFO_BASE (0xF0),
+# so storing one never feeds the GPU, clear of the CPU code that grows up from 0
+VARIABLES_TOP = 0xEF
 
-class Lexer:
-    def __init__(self, text):
-        self.text = text
-        self.pos = 0
-        self.current_char = self.text[0] if text else None
-        
-        self.keywords = {
-            'func', 'draw', 'compute', 'var',
-            'if', 'while', 'end', 'return'
-        }
-
-    def advance(self):
-        self.pos += 1
-        self.current_char = self.text[self.pos] if self.pos < len(self.text) else None
-
-    def skip_whitespace(self):
-        while self.current_char and self.current_char.isspace() and self.current_char != '\n':
-            self.advance()
-
-    def get_number(self):
-        result = ''
-        while self.current_char and (self.current_char.isdigit() or 
-              self.current_char in ['x', 'b'] or 
-              self.current_char in ['a', 'b', 'c', 'd', 'e', 'f']):
-            result += self.current_char
-            self.advance()
-        return result
-
-    def get_identifier(self):
-        result = ''
-        while self.current_char and (self.current_char.isalnum() or self.current_char == '_'):
-            result += self.current_char
-            self.advance()
-        return result
+KEYWORDS = frozenset({
+    'func', 'draw', 'compute', 'var',
+    'if', 'while', 'end', 'return'
+})
 
-    def get_next_token(self):
-        while self.current_char:
-            if self.current_char.isspace() and self.current_char != '\n':
-                self.skip_whitespace()
-                continue
+# Leading blanks and comments, then one alternative per token kind;
+# numbers are 0x.. hex, 0b.. binary or plain decimal
+TOKEN_PATTERN = re.compile(r"""
+    [^\S\n]* (?:\#[^\n]*)?
+    (?:
+        (?P<NUMBER>(?:0[xX][0-9a-fA-F]+|0[bB][01]+|0|[1-9][0-9]*)(?!\w))
+      | (?P<BAD_NUMBER>[0-9]\w*)
+      | (?P<NAME>[^\W\d]\w*)
+      | (?P<NEWLINE>\n)
+      | (?P<OPERATOR>[-+*/=<>()])
+      | (?P<END>\Z)
+      | (?P<INVALID>.)
+    )
+""", re.VERBOSE)
 
-            if self.current_char == '\n':
-                self.advance()
-                return Token(TokenType.NEWLINE, '\n')
+class Token:
+    __slots__ = ('type', 'value', 'line', 'column')
 
-            if self.current_char == '#':
-                while self.current_char and self.current_char != '\n':
-                    self.advance()
-                continue
+    def __init__(self, type, value, line=0, column=0):
+        self.type = type
+        self.value = value
+        self.line = line
+        self.column = column
 
-            if self.current_char.isdigit():
-                return Token(TokenType.NUMBER, self.get_number())
+    def __repr__(self):
+        return f"Token({self.type.name}, {self.value!r}, {self.line}:{self.column})"
 
-            if self.current_char.isalpha() or self.current_char == '_':
-                identifier = self.get_identifier()
-                if identifier in self.keywords:
-                    return Token(TokenType.KEYWORD, identifier)
-                return Token(TokenType.IDENTIFIER, identifier)
+def tokenize(text):
+    """Yield the tokens of text lazily, ending with a single EOF token"""
+    number, identifier, keyword = TokenType.NUMBER, TokenType.IDENTIFIER, TokenType.KEYWORD
+    operator, newline = TokenType.OPERATOR, TokenType.NEWLINE
+    line = 1
+    line_start = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        kind = match.lastgroup
+        value = match.group(kind)
+        start = match.start(kind)
+        if kind == 'NAME':
+            yield Token(keyword if value in KEYWORDS else identifier, value, line, start - line_start + 1)
+        elif kind == 'NUMBER':
+            yield Token(number, value, line, start - line_start + 1)
+        elif kind == 'OPERATOR':
+            yield Token(operator, value, line, start - line_start + 1)
+        elif kind == 'NEWLINE':
+            yield Token(newline, value, line, start - line_start + 1)
+            line += 1
+            line_start = start + 1
+        elif kind == 'END':
+            break
+        elif kind == 'BAD_NUMBER':
+            raise SyntaxError(f"Invalid number {value!r} at line {line}, column {start - line_start + 1}")
+        else:
+            raise SyntaxError(f"Invalid character {value!r} at line {line}, column {start - line_start + 1}")
+    yield Token(TokenType.EOF, None, line, len(text) - line_start + 1)
 
-            if self.current_char in '+-*/=<>()':
-                op = self.current_char
-                self.advance()
-                return Token(TokenType.OPERATOR, op)
+class Lexer:
+    def __init__(self, text):
+        self.text = text
+        self.keywords = KEYWORDS
+        self.tokens = tokenize(text)
+        self.eof = None
 
-            raise SyntaxError(f"Invalid character: {self.current_char}")
+    def __iter__(self):
+        return self.tokens
 
-        return Token(TokenType.EOF, None)
+    def get_next_token(self):
+        """Next token; keeps returning EOF once the text is exhausted"""
+        if self.eof is not None:
+            return self.eof
+        token = next(self.tokens)
+        if token.type is TokenType.EOF:
+            self.eof = token
+        return token
 
 class Compiler:
-    def __init__(self):
-        self.variables = {}
+    def __init__(self, optimize=True, variables_top=VARIABLES_TOP):
+        self.variables = {}   # name -> value after constant folding
+        self.addresses = {}   # name -> memory address, assigned at first declaration
         self.current_section = "CPU"
         self.output = []
+        self.ir = []
+        self.optimize = optimize
+        self.variables_top = variables_top
+
+    def compile(self, source, outputs=None):
+        """Compile source to assembly.
 
-    def compile(self, source):
+        Statements are parsed into IR, constant-folded, stripped of dead
+        stores (keeping only the variables in outputs, if given), the GPU
+        commands coalesced, and lowered; a peephole pass then tidies the
+        assembly. optimize=False skips everything but folding.
+        """
         lexer = Lexer(source)
         token = lexer.get_next_token()
         
         while token.type != TokenType.EOF:
             if token.type == TokenType.KEYWORD:
                 if token.value == 'compute':
-                    self.output.append(".CPU")
+                    self.ir.append(('section', 'CPU'))
                     self.current_section = "CPU"
                 elif token.value == 'draw':
-                    self.output.append(".GPU")
+                    self.ir.append(('section', 'GPU'))
                     self.current_section = "GPU"
                 elif token.value == 'var':
                     token = lexer.get_next_token()
                     if token.type != TokenType.IDENTIFIER:
                         raise SyntaxError("Expected identifier after 'var'")
-                    var_name = token.value
-                    
-                    token = lexer.get_next_token()
-                    if token.type != TokenType.OPERATOR or token.value != '=':
-                        raise SyntaxError("Expected '=' after variable name")
-                    
-                    token = lexer.get_next_token()
-                    if token.type != TokenType.NUMBER:
-                        raise SyntaxError("Expected number after '='")
-                    
-                    self.variables[var_name] = int(token.value, 0)
-                    self.output.append(f"LDA {token.value}")
-                    self.output.append(f"STA {hex(len(self.variables) + 0x20)}")
+                    if token.value not in self.addresses:
+                        self.addresses[token.value] = self.variables_top - len(self.addresses)
+                    token = self.assignment(lexer, token)
+                    continue
 
             elif token.type == TokenType.IDENTIFIER:
                 if self.current_section == "GPU":
                     if token.value == "clear":
-                        self.output.append("CLEAR")
+                        self.ir.append(('asm', "CLEAR", []))
                     elif token.value == "plot":
-                        self.output.append("PLOT")
+                        self.ir.append(('asm', "PLOT", []))
                     elif token.value == "rect":
-                        token = lexer.get_next_token()
-                        width = token.value
-                        token = lexer.get_next_token()
-                        height = token.value
-                        self.output.append(f"RECT {width} {height}")
+                        args, token = self.arguments(lexer, 2)
+                        self.ir.append(('asm', "RECT", args))
+                        continue
+                    elif token.value == "line":
+                        args, token = self.arguments(lexer, 2)
+                        self.ir.append(('asm', "LINE", args))
+                        continue
                     elif token.value == "setpos":
-                        token = lexer.get_next_token()
-                        x = token.value
-                        token = lexer.get_next_token()  # Get y
-                        y = token.value
-                        self.output.append(f"SETX {x}")
-                        self.output.append(f"SETY {y}")
+                        (x, y), token = self.arguments(lexer, 2)
+                        self.ir.append(('asm', "SETX", [x]))
+                        self.ir.append(('asm', "SETY", [y]))
+                        continue
                     elif token.value == "setcolor":
-                        token = lexer.get_next_token()
-                        self.output.append(f"SETC {token.value}")
+                        args, token = self.arguments(lexer, 3)
+                        self.ir.append(('asm', "SETC", args))
+                        continue
+                    elif token.value == "palette":
+                        args, token = self.arguments(lexer, 4)
+                        self.ir.append(('asm', "PAL", args))
+                        continue
+                    elif token.value == "blit":
+                        args, token = self.arguments(lexer, 5)
+                        self.ir.append(('asm', "BLIT", args))
+                        continue
+                    elif token.value in self.addresses:
+                        # stores are lowered into the CPU section, as after 'var'
+                        token = self.assignment(lexer, token)
+                        continue
+                    else:
+                        raise SyntaxError(f"Unknown draw command {token.value} at line {token.line}, column {token.column}")
+                elif token.value in self.addresses:
+                    token = self.assignment(lexer, token)
+                    continue
+                else:
+                    raise SyntaxError(f"Undefined variable {token.value} at line {token.line}, column {token.column}")
 
             token = lexer.get_next_token()
 
-        if self.current_section == "CPU":
-            self.output.append("HALT")
-        else:
-            self.output.append("GHALT")
+        ir = fold_constants(self.ir)
+        self.variables = {statement[1]: statement[2] for statement in ir if statement[0] == 'store'}
+        if self.optimize:
+            ir = eliminate_dead_stores(ir, outputs)
+            ir = optimize_gpu_ir(ir)
+        self.lower(ir)
 
+        if self.optimize:
+            self.output = peephole(self.output)
+        self.check_fit()
         return "\n".join(self.output)
 
+    def check_fit(self):
+        """Raise SyntaxError if the CPU code would run into the variables"""
+        size = 0
+        section = "CPU"
+        for line in self.output:
+            if line.startswith('.'):
+                section = line[1:]
+            elif section == "CPU":
+                size += len(line.split())
+        if self.addresses and size > min(self.addresses.values()):
+            raise SyntaxError(f"Program too large: {size} bytes of CPU code overlap "
+                              f"{len(self.addresses)} variables below {self.variables_top + 1:#x}")
+
+    def assignment(self, lexer, name):
+        """Parse '= expr' after the variable token name; returns the token after it"""
+        token = lexer.get_next_token()
+        if token.type != TokenType.OPERATOR or token.value != '=':
+            raise SyntaxError(f"Expected '=' after variable name at line {token.line}, column {token.column}")
+        expr, token = self.expression(lexer, lexer.get_next_token())
+        if token.type not in (TokenType.NEWLINE, TokenType.EOF):
+            raise SyntaxError(f"Unexpected {token.value!r} at line {token.line}, column {token.column}")
+        self.ir.append(('assign', name.value, expr, name.line, name.column))
+        return token
+
+    def arguments(self, lexer, count):
+        """Parse count GPU arguments (numbers or variables); returns (args, next token)"""
+        args = []
+        token = lexer.get_next_token()
+        for _ in range(count):
+            arg, token = self.factor(lexer, token)
+            args.append(arg)
+        return args, token
+
+    def expression(self, lexer, token):
+        """expr := term (('+' | '-') term)*; returns (expr, next token)"""
+        left, token = self.term(lexer, token)
+        while token.type == TokenType.OPERATOR and token.value in '+-':
+            op = token.value
+            right, token = self.term(lexer, lexer.get_next_token())
+            left = (op, left, right)
+        return left, token
+
+    def term(self, lexer, token):
+        """term := factor (('*' | '/') factor)*"""
+        left, token = self.factor(lexer, token)
+        while token.type == TokenType.OPERATOR and token.value in '*/':
+            op = token.value
+            right, token = self.factor(lexer, lexer.get_next_token())
+            left = (op, left, right)
+        return left, token
+
+    def factor(self, lexer, token):
+        """factor := NUMBER | variable | '(' expr ')'"""
+        if token.type == TokenType.NUMBER:
+            value = int(token.value, 0)
+            if value > 255:
+                raise SyntaxError(f"Number too large: {token.value} at line {token.line}, column {token.column}")
+            return ('num', value), lexer.get_next_token()
+        if token.type == TokenType.IDENTIFIER:
+            return ('var', token.value), lexer.get_next_token()
+        if token.type == TokenType.OPERATOR and token.value == '(':
+            expr, token = self.expression(lexer, lexer.get_next_token())
+            if token.type != TokenType.OPERATOR or token.value != ')':
+                raise SyntaxError(f"Expected ')' at line {token.line}, column {token.column}")
+            return expr, lexer.get_next_token()
+        raise SyntaxError(f"Expected number or variable at line {token.line}, column {token.column}")
+
+    def lower(self, ir):
+        """Append assembly for folded IR to self.output.
+
+        Section directives are only emitted when code actually changes
+        section; stores inside a draw block go to the CPU section. The
+        final section gets its halt, then any other section given code.
+        """
+        section = "CPU"   # section the statements belong to
+        emitted = None    # section of the last directive written
+        used = set()
+        for statement in ir:
+            kind = statement[0]
+            if kind == 'section':
+                section = statement[1]
+                continue
+            target = "CPU" if kind == 'store' else section
+            if target != emitted:
+                self.output.append(f".{target}")
+                emitted = target
+            used.add(target)
+            if kind == 'store':
+                _, name, value = statement
+                self.output += [f"LDA {value}", f"STA {hex(self.addresses[name])}"]
+            else:
+                _, instruction, args = statement
+                self.output.append(" ".join([instruction] + [str(value) for value in args]))
+
+        halts = {"CPU": "HALT", "GPU": "GHALT"}
+        for target in sorted(used | {section}, key=lambda name: name != section):
+            if target != emitted:
+                self.output.append(f".{target}")
+                emitted = target
+            self.output.append(halts[target])
+
 if __name__ == "__main__":
     source_code = """
     compute
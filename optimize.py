@@ -0,0 +1,377 @@
+# Optimization passes for lang programs and the assembly they compile to.
+#
+# IR statements are tuples:
+#   ('section', 'CPU' | 'GPU')
+#   ('assign', name, expr, line, column)   expr: ('num', n) | ('var', name) | (op, left, right)
+#   ('store', name, value)                 assign folded to a constant
+#   ('asm', instruction, args)             other instructions; args are exprs, folded to ints
+
+from assembler import Assembler
+
+
+def evaluate(expr, env):
+    """Value of expr with 8-bit wraparound, or None if it reads an unknown variable"""
+    kind = expr[0]
+    if kind == 'num':
+        return expr[1] & 0xFF
+    if kind == 'var':
+        return env.get(expr[1])
+
+    left = evaluate(expr[1], env)
+    right = evaluate(expr[2], env)
+    if left is None or right is None:
+        return None
+    if kind == '+':
+        return (left + right) & 0xFF
+    if kind == '-':
+        return (left - right) & 0xFF
+    if kind == '*':
+        return (left * right) & 0xFF
+    if right == 0:
+        raise ZeroDivisionError
+    return left // right
+
+
+def fold_constants(ir):
+    """Propagate known variable values and fold every assignment to a store"""
+    env = {}
+    folded = []
+    for statement in ir:
+        if statement[0] == 'assign':
+            _, name, expr, line, column = statement
+            try:
+                value = evaluate(expr, env)
+            except ZeroDivisionError:
+                raise SyntaxError(f"Division by zero at line {line}, column {column}") from None
+            if value is None:
+                raise SyntaxError(f"Undefined variable in assignment to {name} at line {line}, column {column}")
+            env[name] = value
+            statement = ('store', name, value)
+        elif statement[0] == 'asm' and statement[2]:
+            _, instruction, args = statement
+            values = [evaluate(arg, env) for arg in args]
+            if None in values:
+                raise SyntaxError(f"Undefined variable in {instruction} arguments")
+            statement = ('asm', instruction, values)
+        folded.append(statement)
+    return folded
+
+
+def eliminate_dead_stores(ir, outputs=None):
+    """Drop stores that are overwritten later or whose variable is not an output.
+
+    Lowered code never loads a variable back from memory, so only the
+    last store of each variable can be observed. outputs limits which
+    variables need to reach memory at all; None keeps every variable.
+    """
+    last = {}
+    for index, statement in enumerate(ir):
+        if statement[0] == 'store':
+            last[statement[1]] = index
+    return [
+        statement for index, statement in enumerate(ir)
+        if statement[0] != 'store'
+        or (last[statement[1]] == index and (outputs is None or statement[1] in outputs))
+    ]
+
+
+def _operand(token):
+    try:
+        return int(token, 0)
+    except ValueError:
+        return token
+
+
+def peephole(lines):
+    """Remove CPU loads that cannot change anything.
+
+    - LDA of the value the accumulator already holds (LDA/ADD/SUB leave
+      zero_flag == (A == 0), so reloading the same value is a no-op)
+    - LDA immediately overwritten by another LDA (LDA never touches carry)
+
+    Knowledge of A is dropped at labels, jumps and section changes.
+    """
+    out = []
+    known = None      # operand the accumulator is known to hold
+    pending = None    # index in out of an LDA nothing has observed yet
+    for line in lines:
+        code = line.split(';')[0]
+        if ':' in code or code.strip().startswith('.'):
+            known = pending = None
+            out.append(line)
+            continue
+
+        parts = code.split()
+        instruction = parts[0].upper() if parts else ''
+        if instruction == 'LDA' and len(parts) == 2:
+            value = _operand(parts[1])
+            if value == known:
+                continue
+            if pending is not None:
+                out[pending] = None
+            known = value
+            pending = len(out)
+        elif instruction in ('', 'NOP'):
+            pass
+        elif instruction == 'STA':
+            pending = None
+        else:
+            known = pending = None
+        out.append(line)
+    return [line for line in out if line is not None]
+
+
+# GPU command stream
+
+GPU_OPCODES = Assembler().gpu_instructions
+GPU_OPERANDS = {GPU_OPCODES[name]: count for name, count in Assembler().gpu_operands.items()}
+GNOP, SETX, SETY, SETC, PLOT, CLEAR, LINE, RECT, PAL, BLIT, GHALT = (
+    GPU_OPCODES[name] for name in
+    ('GNOP', 'SETX', 'SETY', 'SETC', 'PLOT', 'CLEAR', 'LINE', 'RECT', 'PAL', 'BLIT', 'GHALT'))
+
+GPU_NAMES = {opcode: name for name, opcode in GPU_OPCODES.items()}
+
+WHITE = (255, 255, 255)  # colour register after GPU.reset_state
+MAX_SPAN = 255           # largest RECT operand
+REORDER_WINDOW = 256     # draws considered together when grouping by colour
+BLIT_INDICES = 0x02      # gpu.BLIT_INDICES, kept here so the optimizer needs no numpy
+
+
+def optimize_gpu_ir(ir, width=640, height=480):
+    """Pull every GPU instruction out of folded IR into one optimized GPU section at the end.
+
+    The GPU section is a single stream however the statements were
+    interleaved with CPU code, so it is optimized as a whole.
+    """
+    rest = []
+    commands = []
+    section = 'CPU'
+    for statement in ir:
+        if statement[0] == 'section':
+            section = statement[1]
+        if statement[0] == 'asm' and section == 'GPU':
+            commands.append((GPU_OPCODES[statement[1]], tuple(statement[2])))
+        else:
+            rest.append(statement)
+    if not commands:
+        return ir
+    rest.append(('section', 'GPU'))
+    for opcode, args in coalesce_gpu(commands, width, height):
+        rest.append(('asm', GPU_NAMES[opcode], list(args)))
+    return rest
+
+
+def decode_gpu(code):
+    """Split GPU machine code into (opcode, args) commands and an undecodable tail"""
+    commands = []
+    pc = 0
+    while pc < len(code):
+        opcode = code[pc]
+        count = GPU_OPERANDS.get(opcode)
+        if count is None or pc + count >= len(code):
+            break
+        commands.append((opcode, tuple(code[pc + 1:pc + 1 + count])))
+        pc += 1 + count
+    return commands, bytes(code[pc:])
+
+
+def optimize_gpu(code, width=640, height=480):
+    """Optimized GPU machine code producing the same frames (see coalesce_gpu)"""
+    commands, tail = decode_gpu(code)
+    out = bytearray()
+    for opcode, args in coalesce_gpu(commands, width, height):
+        out.append(opcode)
+        out.extend(args)
+    return bytes(out) + tail
+
+
+def coalesce_gpu(commands, width=640, height=480):
+    """Rewrite (opcode, args) GPU commands to dispatch fewer of them.
+
+    Commands are replayed against the register state GPU.run starts
+    from, turning each draw into an absolute (kind, x, y, a, b, colour)
+    op. Within a frame (up to GHALT) draws before a CLEAR are dropped,
+    independent draws are grouped by colour, runs of same-colour PLOTs
+    become span/rect fills, and SETX/SETY/SETC are only emitted when a
+    draw needs a different value. Registers are brought back to their
+    original values at every GHALT and at the end, so frames() sees the
+    same state too.
+
+    In indexed mode colours may claim different palette entries, which
+    only matters once PAL rewrites an entry or a BLIT draws raw palette
+    indices, so such streams are returned as they are.
+    """
+    if any(opcode == PAL or opcode == BLIT and args[4] & BLIT_INDICES for opcode, args in commands):
+        return list(commands)
+    out = []
+    emitted = [0, 0, WHITE]
+    x = y = 0
+    colour = WHITE
+    ops = []
+    frame_start = 0  # index of the first command of the current frame
+    frame_out = 0    # index in out where that frame's commands start
+    for index, (opcode, args) in enumerate(commands):
+        if opcode == SETX:
+            x = args[0] % width
+        elif opcode == SETY:
+            y = args[0] % height
+        elif opcode == SETC:
+            colour = tuple(args)
+        elif opcode == PLOT:
+            ops.append((PLOT, x, y, 1, 1, colour))
+        elif opcode == RECT:
+            if x < min(x + args[0], width) and y < min(y + args[1], height):
+                ops.append((RECT, x, y, args[0], args[1], colour))
+        elif opcode == LINE:
+            ops.append((LINE, x, y, args[0] % width, args[1] % height, colour))
+        elif opcode == CLEAR:
+            ops = [(CLEAR,)]
+        elif opcode == BLIT:
+            # Its pixels come from memory the stream says nothing about: draw it in order
+            _flush(ops, out, emitted, width, height)
+            _materialize(out, emitted, x, y, emitted[2])
+            out.append((BLIT, tuple(args)))
+            ops = []
+        elif opcode == GHALT:
+            _flush(ops, out, emitted, width, height)
+            _materialize(out, emitted, x, y, colour)
+            out.append((GHALT, ()))
+            ops = []
+            frame_start = index + 1
+            frame_out = len(out)
+    _flush(ops, out, emitted, width, height)
+    _materialize(out, emitted, x, y, colour)
+    if frame_start < len(commands) and len(out) == frame_out:
+        out.append((GNOP, ()))  # frames() still ends a last, unchanged frame here
+    return out
+
+
+def _materialize(out, emitted, x, y, colour):
+    """Emit whichever of SETX/SETY/SETC differ from the registers already set"""
+    if emitted[0] != x:
+        out.append((SETX, (x,)))
+        emitted[0] = x
+    if emitted[1] != y:
+        out.append((SETY, (y,)))
+        emitted[1] = y
+    if emitted[2] != colour:
+        out.append((SETC, colour))
+        emitted[2] = colour
+
+
+def _flush(ops, out, emitted, width, height):
+    """Emit one frame segment of draw ops"""
+    if ops and ops[0][0] == CLEAR:
+        out.append((CLEAR, ()))
+        ops = ops[1:]
+    draws = _merge_plots(ops)
+    scheduled = []
+    for start in range(0, len(draws), REORDER_WINDOW):
+        scheduled += _group_by_colour(draws[start:start + REORDER_WINDOW],
+                                      scheduled[-1][5] if scheduled else emitted[2],
+                                      width, height)
+    for kind, x, y, a, b, colour in _merge_plots(scheduled):
+        _materialize(out, emitted, x, y, colour)
+        out.append((PLOT, ()) if kind == PLOT else (kind, (a, b)))
+
+
+def _merge_plots(ops):
+    """Cover each run of consecutive same-colour PLOTs with as few fills as possible.
+
+    Same-colour draws commute, so a run's PLOTs can be replaced by any
+    set of fills covering the same pixels: row spans first, then equal
+    spans on consecutive rows stacked into rects.
+    """
+    merged = []
+    i = 0
+    while i < len(ops):
+        colour = ops[i][5]
+        j = i
+        pixels = set()
+        while j < len(ops) and ops[j][5] == colour:
+            if ops[j][0] == PLOT:
+                pixels.add((ops[j][2], ops[j][1]))
+            else:
+                merged.append(ops[j])
+            j += 1
+        if len(pixels) == 1:
+            (y, x), = pixels
+            merged.append((PLOT, x, y, 1, 1, colour))
+        elif pixels:
+            merged += _cover(sorted(pixels), colour)
+        i = j
+    return merged
+
+
+def _cover(pixels, colour):
+    """Rects covering sorted (y, x) pixels, in row-major order"""
+    spans = {}  # (x, length) -> rows it occurs on
+    start = None
+    for y, x in pixels:
+        if start is None:
+            start, row, last = x, y, x
+        elif y == row and x == last + 1 and x - start < MAX_SPAN:
+            last = x
+        else:
+            spans.setdefault((start, last - start + 1), []).append(row)
+            start, row, last = x, y, x
+    spans.setdefault((start, last - start + 1), []).append(row)
+
+    rects = []
+    for (x, length), rows in spans.items():
+        top = previous = rows[0]
+        for y in rows[1:] + [None]:
+            if y is not None and y == previous + 1 and y - top < MAX_SPAN:
+                previous = y
+                continue
+            height = previous - top + 1
+            if length == 1 and height == 1:
+                rects.append((PLOT, x, top, 1, 1, colour))
+            else:
+                rects.append((RECT, x, top, length, height, colour))
+            top = previous = y
+    rects.sort(key=lambda op: (op[2], op[1]))
+    return rects
+
+
+def _bounds(op, width, height):
+    kind, x, y, a, b, _ = op
+    if kind == LINE:
+        return min(x, a), min(y, b), max(x, a) + 1, max(y, b) + 1
+    return x, y, min(x + a, width), min(y + b, height)
+
+
+def _group_by_colour(ops, colour, width, height):
+    """Reorder draws so same-colour ones are adjacent, never swapping overlapping
+    draws of different colours. Greedy: keep drawing in the current colour
+    while any such draw is ready, otherwise take the earliest ready draw.
+    """
+    import numpy as np  # only needed here; keeps numpy out of plain lang imports
+
+    if len(ops) < 2:
+        return ops
+    x0, y0, x1, y1 = np.array([_bounds(op, width, height) for op in ops]).T
+    colours = [op[5] for op in ops]
+    ids = {c: n for n, c in enumerate(set(colours))}
+    colour_ids = np.array([ids[c] for c in colours])
+    # must_follow[i, j]: draw j overlaps earlier draw i in another colour
+    must_follow = ((x0[:, None] < x1[None, :]) & (x0[None, :] < x1[:, None])
+                   & (y0[:, None] < y1[None, :]) & (y0[None, :] < y1[:, None])
+                   & (colour_ids[:, None] != colour_ids[None, :]))
+    must_follow = np.triu(must_follow, 1)
+    waiting = must_follow.sum(axis=0).tolist()
+    followers = [np.flatnonzero(row).tolist() for row in must_follow]
+
+    ready = [n for n in range(len(ops)) if not waiting[n]]
+    order = []
+    while ready:
+        pick = next((n for n in ready if colours[n] == colour), ready[0])
+        ready.remove(pick)
+        order.append(ops[pick])
+        colour = colours[pick]
+        for n in followers[pick]:
+            waiting[n] -= 1
+            if not waiting[n]:
+                ready.append(n)
+        ready.sort()
+    return order
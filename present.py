@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+LATENCY_SAMPLES = 256  # recent frames kept for the latency figures
+
+
+class Presenter:
+    """Double-buffered frame presentation on a background thread.
+
+    commit() copies VRAM into the back buffer and returns; the thread
+    swaps it to the front, scales it and hands it to sink(frame), so the
+    emulator keeps drawing the next frame meanwhile (NumPy copies and
+    pygame blits release the GIL). A frame still waiting in the back
+    buffer when the next one is committed is dropped, never queued.
+
+    Attach with gpu.presenter = Presenter(gpu, sink) and every GHALT
+    (or gpu.swap()) commits. sink may be any callable taking an
+    (h, w, 3) uint8 array, e.g. a capture writer's write or window_sink().
+    """
+
+    def __init__(self, gpu, sink, scale=1):
+        self.gpu = gpu
+        self.sink = sink
+        self.scale = scale
+        self.back = np.empty_like(gpu.vram)
+        self.front = np.empty_like(gpu.vram)
+        # indexed VRAM is committed with its palette and only expanded on this thread
+        self.back_palette = np.empty_like(gpu.palette)
+        self.front_palette = np.empty_like(gpu.palette)
+
+        self.committed = 0
+        self.presented = 0
+        self.dropped = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)  # seconds from commit to sink return
+
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._pending = None  # commit time of the frame in the back buffer
+        self._closing = False
+        self._thread = threading.Thread(target=self._present_loop, name="presenter", daemon=True)
+        self._thread.start()
+
+    def commit(self):
+        """Hand the current VRAM over as a finished frame"""
+        with self._ready:
+            if self._pending is not None:
+                self.dropped += 1
+            np.copyto(self.back, self.gpu.vram)
+            if self.gpu.indexed:
+                np.copyto(self.back_palette, self.gpu.palette)
+            self._pending = time.perf_counter()
+            self.committed += 1
+            self._ready.notify()
+
+    def _present_loop(self):
+        while True:
+            with self._ready:
+                while self._pending is None and not self._closing:
+                    self._ready.wait()
+                if self._pending is None:
+                    return
+                self.front, self.back = self.back, self.front
+                self.front_palette, self.back_palette = self.back_palette, self.front_palette
+                committed_at = self._pending
+                self._pending = None
+
+            frame = self.front
+            if self.gpu.indexed:
+                frame = self.front_palette.take(frame, axis=0)
+            if self.scale != 1:
+                frame = frame.repeat(self.scale, axis=0).repeat(self.scale, axis=1)
+            self.sink(frame)
+            self.latencies.append(time.perf_counter() - committed_at)
+            self.presented += 1
+
+    def stats(self):
+        """Frame counters and commit-to-present latency over recent frames, in ms"""
+        latencies = list(self.latencies)
+        return {
+            "committed": self.committed,
+            "presented": self.presented,
+            "dropped": self.dropped,
+            "latency_ms_mean": 1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+            "latency_ms_max": 1000 * max(latencies) if latencies else 0.0,
+        }
+
+    def close(self):
+        """Present whatever is still pending, then stop the thread"""
+        with self._ready:
+            self._closing = True
+            self._ready.notify()
+        self._thread.join()
+        if self.gpu.presenter is self:
+            self.gpu.presenter = None
+
+    def __enter__(self):
+        self.gpu.presenter = self
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def window_sink(title="GPU"):
+    """Sink that shows frames in a pygame window, opened by the presenter thread on first use"""
+    import pygame
+
+    state = {}
+
+    def show(frame):
+        screen = state.get("screen")
+        if screen is None or screen.get_size() != (frame.shape[1], frame.shape[0]):
+            pygame.init()
+            screen = state["screen"] = pygame.display.set_mode((frame.shape[1], frame.shape[0]))
+            pygame.display.set_caption(title)
+        pygame.event.pump()
+        # surfarray indexes pixels as [x, y], so hand it a transposed view
+        pygame.surfarray.blit_array(screen, frame.transpose(1, 0, 2))
+        pygame.display.flip()
+
+    return show
@@ -0,0 +1,190 @@
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from archi import JITCPU
+from assembler import Assembler
+
+SLICE_CYCLES = 100_000  # cycles between wall-clock checks
+
+# Warm per-process emulators, created once by init_worker and reset per job
+_cpu = None
+_gpu = None
+_cache_dir = None
+
+
+def digest(data):
+    """Short content digest used in result records"""
+    return hashlib.blake2b(bytes(data), digest_size=16).hexdigest()
+
+
+def load_jobs(programs):
+    """Normalise a directory path or an iterable of programs into (name, source, kind) jobs.
+
+    Iterables may hold source strings or (name, source) pairs; kind is
+    'lang' for .lang files and 'asm' for everything else.
+    """
+    if isinstance(programs, (str, os.PathLike)):
+        jobs = []
+        for name in sorted(os.listdir(programs)):
+            path = os.path.join(programs, name)
+            if os.path.isfile(path) and name.endswith((".asm", ".lang")):
+                with open(path) as f:
+                    jobs.append((name, f.read(), "lang" if name.endswith(".lang") else "asm"))
+        return jobs
+
+    jobs = []
+    for i, program in enumerate(programs):
+        name, source = program if isinstance(program, tuple) else (str(i), program)
+        jobs.append((name, source, "lang" if str(name).endswith(".lang") else "asm"))
+    return jobs
+
+
+def init_worker(vram=False, cache_dir=None):
+    """Create this process's emulators; the GPU only when VRAM digests are wanted"""
+    global _cpu, _gpu, _cache_dir
+    _cpu = JITCPU()
+    _cache_dir = cache_dir
+    if vram:
+        from gpu import GPU
+        _gpu = GPU()
+
+
+def run_cpu(cpu, max_cycles=None, time_limit=None, start=None):
+    """Run a loaded CPU from address 0 in slices; returns the status for the record.
+
+    One of "halted", "unknown-instruction", "infinite-loop", "cycle-limit"
+    or "timeout" (time_limit seconds after start, which defaults to now).
+    """
+    if max_cycles is not None and max_cycles < 0:
+        raise ValueError(f"max_cycles must be non-negative, got {max_cycles}")
+    if start is None:
+        start = time.perf_counter()
+    cpu.PC = 0
+    cpu.cycles = 0
+    while True:
+        budget = SLICE_CYCLES
+        if max_cycles is not None:
+            budget = min(budget, max_cycles - cpu.cycles)
+        cpu.resume(budget)
+        if cpu.halt_reason == "infinite-loop" and max_cycles is not None:
+            # resume only fast-forwarded to the end of this slice; the loop would run out the budget
+            cpu.skip_loop(max_cycles - cpu.cycles)
+        if not cpu.running:
+            return "halted" if cpu.halt_reason == "halt" else cpu.halt_reason
+        if max_cycles is not None and cpu.cycles >= max_cycles:
+            return "cycle-limit"
+        if time_limit is not None and time.perf_counter() - start >= time_limit:
+            return "timeout"
+
+
+def run_job(job, max_cycles=None, time_limit=None):
+    """Assemble and run one (name, source, kind) job on the warm emulators"""
+    name, source, kind = job
+    start = time.perf_counter()
+    record = {"name": name}
+    # CPU diagnostics (unknown opcodes) go to stderr so stdout stays JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        _execute(record, source, kind, start, max_cycles, time_limit)
+    record["seconds"] = round(time.perf_counter() - start, 6)
+    return record
+
+
+def _execute(record, source, kind, start, max_cycles, time_limit):
+    try:
+        if kind == "lang":
+            import lang
+            source = lang.Compiler().compile(source)
+        assembler = Assembler()
+        if _cache_dir is not None:
+            obj = assembler.assemble_cached(source, _cache_dir)
+        else:
+            obj = assembler.assemble_object(source)
+        cpu_code, gpu_code = obj.cpu, obj.gpu
+
+        cpu = _cpu
+        cpu.reset()
+        cpu.load_program(cpu_code)
+        status = run_cpu(cpu, max_cycles, time_limit, start) if cpu_code else "halted"
+
+        record.update(
+            status=status,
+            A=cpu.A, B=cpu.B, PC=cpu.PC,
+            zero_flag=cpu.zero_flag, carry_flag=cpu.carry_flag,
+            cycles=cpu.cycles,
+            memory_digest=digest(cpu.memory),
+        )
+
+        if _gpu is not None:
+            _gpu.reset()
+            _gpu.memory = cpu.memory
+            if gpu_code:
+                _gpu.load_program(gpu_code)
+            record["vram_digest"] = digest(_gpu.vram)
+    except (ValueError, SyntaxError, IndexError) as e:
+        record.update(status="error", error=f"{type(e).__name__}: {e}")
+
+
+def _run_chunk(chunk, max_cycles, time_limit):
+    return [run_job(job, max_cycles, time_limit) for job in chunk]
+
+
+def run_batch(programs, workers=None, chunksize=8, max_cycles=None, time_limit=None, vram=False,
+              cache_dir=None):
+    """Run many programs over a process pool, yielding result records in input order.
+
+    programs is a directory or an iterable accepted by load_jobs. Jobs are
+    sent to workers in chunks of chunksize; workers=1 runs in this process.
+    With cache_dir, assembled objects are cached there by source hash.
+    """
+    jobs = load_jobs(programs)
+    chunks = [jobs[i:i + chunksize] for i in range(0, len(jobs), chunksize)]
+
+    if workers == 1:
+        init_worker(vram, cache_dir)
+        for chunk in chunks:
+            yield from _run_chunk(chunk, max_cycles, time_limit)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(vram, cache_dir)) as pool:
+        results = pool.map(_run_chunk, chunks,
+                           [max_cycles] * len(chunks), [time_limit] * len(chunks))
+        for chunk_results in results:
+            yield from chunk_results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Assemble and run a directory of programs in parallel")
+    parser.add_argument("directory", help="directory of .asm / .lang programs")
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: all cores)")
+    parser.add_argument("--chunksize", type=int, default=8)
+    parser.add_argument("--max-cycles", type=int, default=None)
+    parser.add_argument("--timeout", type=float, default=None, help="per-job seconds")
+    parser.add_argument("--vram", action="store_true", help="run GPU code and record a VRAM digest")
+    parser.add_argument("--cache", metavar="DIR", help="reuse assembled objects cached in DIR")
+    parser.add_argument("--output", help="write JSON lines here instead of stdout")
+    args = parser.parse_args(argv)
+    if args.max_cycles is not None and args.max_cycles < 0:
+        parser.error("--max-cycles must be non-negative")
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    counts = {}
+    try:
+        for record in run_batch(args.directory, args.workers, args.chunksize,
+                                args.max_cycles, args.timeout, args.vram, args.cache):
+            out.write(json.dumps(record) + "\n")
+            counts[record["status"]] = counts.get(record["status"], 0) + 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(", ".join(f"{n} {status}" for status, n in sorted(counts.items())), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+import argparse
+import asyncio
+import base64
+import contextlib
+import hashlib
+import io
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from archi import JITCPU
+from assembler import Assembler, ObjectFile
+from runner import digest, run_cpu
+
+POOL_SIZE = 4                # warm CPU/GPU pairs, and so requests emulated at once
+MAX_QUEUE = 64               # requests allowed to wait for an emulator before answering 503
+MAX_CYCLES = 10_000_000      # per-request cycle budget, and the most a request may ask for
+ARTIFACT_CACHE_SIZE = 1024   # assembled objects kept by content hash
+LATENCY_SAMPLES = 1024       # recent requests kept for the latency figures
+MAX_BODY = 4 << 20           # largest request body accepted, in bytes
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 503: "Service Unavailable"}
+
+
+class Busy(Exception):
+    """Every emulator is taken and the wait queue is full"""
+
+
+class ArtifactCache:
+    """Assembled ObjectFiles keyed by a hash of (kind, source), least recently used dropped first"""
+
+    def __init__(self, size=ARTIFACT_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, kind, source):
+        """The object for lang or assembly source, compiling and assembling it on a miss"""
+        key = hashlib.blake2b(kind.encode() + b"\0" + source.encode(), digest_size=16).digest()
+        with self._lock:
+            obj = self.entries.get(key)
+            if obj is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return obj
+
+        if kind == "lang":
+            import lang
+            source = lang.Compiler().compile(source)
+        obj = Assembler().assemble_object(source)
+
+        with self._lock:
+            self.misses += 1
+            self.entries[key] = obj
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return obj
+
+
+class ThreadOutput:
+    """sys.stdout stand-in that sends each thread's writes to the buffer it set, if any"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        return getattr(self.local, "buffer", self.stream).write(text)
+
+    def flush(self):
+        getattr(self.local, "buffer", self.stream).flush()
+
+
+@contextlib.contextmanager
+def capture_stdout(buffer):
+    """Send what this thread prints to buffer.
+
+    Under serve, sys.stdout is a ThreadOutput and only this thread's writes
+    move; anywhere else this is plain contextlib.redirect_stdout.
+    """
+    stdout = sys.stdout
+    if not isinstance(stdout, ThreadOutput):
+        with contextlib.redirect_stdout(buffer):
+            yield
+        return
+    stdout.local.buffer = buffer
+    try:
+        yield
+    finally:
+        del stdout.local.buffer
+
+
+def execute(cpu, gpu, obj, max_cycles, time_limit=None, memory=False, png=False):
+    """Reset a warm CPU/GPU pair, run obj on it and return the result record.
+
+    What the CPU prints (unknown-opcode diagnostics) comes back as
+    "diagnostics" rather than on the server's stdout.
+    """
+    start = time.perf_counter()
+    output = io.StringIO()
+    with capture_stdout(output):
+        cpu.reset()
+        gpu.reset()
+        cpu.load_program(obj.cpu)
+        if obj.cpu:
+            status = run_cpu(cpu, max_cycles, time_limit, start)
+            halt_reason = cpu.halt_reason
+        else:
+            status, halt_reason = "halted", "halt"  # no CPU code: stopped before it started
+
+        gpu.memory = cpu.memory
+        if obj.gpu:
+            gpu.load_program(obj.gpu)
+    result = {
+        "status": status,
+        "halt_reason": halt_reason,
+        "A": cpu.A, "B": cpu.B, "PC": cpu.PC,
+        "zero_flag": cpu.zero_flag, "carry_flag": cpu.carry_flag,
+        "cycles": cpu.cycles,
+        "memory_digest": digest(cpu.memory),
+        "vram_digest": digest(gpu.vram),
+        "diagnostics": output.getvalue(),
+    }
+    if memory:
+        result["memory"] = base64.b64encode(bytes(cpu.memory)).decode()
+    if png:
+        from capture import encode_png
+        result["png"] = base64.b64encode(encode_png(gpu.to_rgb(), level=1)).decode()
+    return result
+
+
+class Service:
+    """Runs programs sent over HTTP on a pool of warm emulators.
+
+    POST /run takes a JSON object:
+
+        kind        "lang", "asm" (default) or "image"
+        source      lang or assembly source, for those kinds
+        image, gpu  base64 CPU memory image and GPU program, for "image"
+        max_cycles  cycle budget of at least 1, capped at the service's max_cycles
+        time_limit  non-negative seconds of emulation before giving up
+        memory      also return CPU memory, base64
+        png         also return the final frame as a base64 PNG
+
+    and answers with registers, status, digests, whatever the CPU printed
+    and per-request timings.
+    GET /stats reports counters, cache hits and recent latencies.
+
+    At most pool_size requests are emulated at once, on a thread pool
+    so the event loop keeps accepting connections; up to max_queue more
+    wait for an emulator and anything beyond that gets a 503.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, max_queue=MAX_QUEUE, max_cycles=MAX_CYCLES,
+                 cache_size=ARTIFACT_CACHE_SIZE, indexed=False):
+        from gpu import GPU
+
+        self.max_queue = max_queue
+        self.max_cycles = max_cycles
+        self.cache = ArtifactCache(cache_size)
+        self.executor = ThreadPoolExecutor(pool_size, thread_name_prefix="emulator")
+        self.emulators = [(JITCPU(), GPU(indexed=indexed)) for _ in range(pool_size)]
+        self.idle = None  # asyncio.Queue of free emulators, made on the service's loop
+
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.busy = 0
+        self.admitted = 0  # requests between admission and response
+        self.waiting = 0
+        self.running = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)  # seconds from request to response
+
+    async def run(self, request):
+        """Run one /run request, returning its result record"""
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        if self.idle is None:
+            self.idle = asyncio.Queue()
+            for emulator in self.emulators:
+                self.idle.put_nowait(emulator)
+        if self.admitted >= len(self.emulators) + self.max_queue:
+            raise Busy()
+        self.admitted += 1
+        try:
+            return await self._run(request, start, loop)
+        finally:
+            self.admitted -= 1
+
+    async def _run(self, request, start, loop):
+        """Build the object, wait for an emulator and run on it"""
+        kind = request.get("kind", "asm")
+        if kind == "image":
+            obj = ObjectFile(base64.b64decode(request.get("image", ""), validate=True),
+                             base64.b64decode(request.get("gpu", ""), validate=True))
+        elif kind in ("lang", "asm"):
+            source = request.get("source")
+            if not isinstance(source, str):
+                raise ValueError("source must be a string")
+            obj = await loop.run_in_executor(self.executor, self.cache.get, kind, source)
+        else:
+            raise ValueError(f"Unknown kind: {kind}")
+        max_cycles = request.get("max_cycles")
+        if max_cycles is None:
+            max_cycles = self.max_cycles
+        if not isinstance(max_cycles, int) or isinstance(max_cycles, bool) or max_cycles < 1:
+            raise ValueError("max_cycles must be a positive integer")
+        max_cycles = min(max_cycles, self.max_cycles)
+        time_limit = request.get("time_limit")
+        if time_limit is not None and (not isinstance(time_limit, (int, float))
+                                       or isinstance(time_limit, bool) or not time_limit >= 0):
+            raise ValueError("time_limit must be a non-negative number of seconds")
+        compiled = time.perf_counter()
+
+        self.waiting += 1
+        try:
+            emulator = await self.idle.get()
+        finally:
+            self.waiting -= 1
+        acquired = time.perf_counter()
+        self.running += 1
+        try:
+            result = await loop.run_in_executor(
+                self.executor, execute, *emulator, obj, max_cycles, time_limit,
+                bool(request.get("memory")), bool(request.get("png")))
+        finally:
+            self.running -= 1
+            self.idle.put_nowait(emulator)
+
+        done = time.perf_counter()
+        result["timing_ms"] = {
+            "compile": round(1000 * (compiled - start), 3),
+            "queue": round(1000 * (acquired - compiled), 3),
+            "run": round(1000 * (done - acquired), 3),
+            "total": round(1000 * (done - start), 3),
+        }
+        return result
+
+    def stats(self):
+        """Counters, cache figures and latency over recent requests, in ms"""
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return 1000 * latencies[min(int(p * len(latencies)), len(latencies) - 1)] if latencies else 0.0
+
+        return {
+            "uptime_s": round(time.time() - self.started, 3),
+            "requests": self.requests,
+            "errors": self.errors,
+            "busy": self.busy,
+            "running": self.running,
+            "waiting": self.waiting,
+            "pool_size": len(self.emulators),
+            "cache": {"entries": len(self.cache.entries),
+                      "hits": self.cache.hits, "misses": self.cache.misses},
+            "latency_ms": {
+                "mean": 1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "max": 1000 * latencies[-1] if latencies else 0.0,
+            },
+        }
+
+    async def dispatch(self, method, path, body):
+        """(HTTP status, JSON payload) for one request"""
+        if path == "/stats":
+            if method != "GET":
+                return 405, {"error": "use GET"}
+            return 200, self.stats()
+        if path != "/run":
+            return 404, {"error": f"no such endpoint: {path}"}
+        if method != "POST":
+            return 405, {"error": "use POST"}
+
+        start = time.perf_counter()
+        self.requests += 1
+        try:
+            request = json.loads(body)
+            if not isinstance(request, dict):
+                raise ValueError("request body must be a JSON object")
+            result = await self.run(request)
+        except Busy:
+            self.busy += 1
+            return 503, {"error": "all emulators busy, try again"}
+        except (ValueError, SyntaxError, IndexError, TypeError) as e:
+            self.errors += 1
+            return 400, {"error": f"{type(e).__name__}: {e}"}
+        self.latencies.append(time.perf_counter() - start)
+        return 200, result
+
+    async def handle(self, reader, writer):
+        """Serve HTTP/1.1 requests on one connection, keeping it alive unless asked not to"""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                parts = line.decode("latin-1").split()
+                length = int(headers.get("content-length", 0) or 0)
+                if len(parts) != 3:
+                    status, payload, keep = 400, {"error": "malformed request line"}, False
+                elif length > MAX_BODY:
+                    status, payload, keep = 413, {"error": f"body over {MAX_BODY} bytes"}, False
+                else:
+                    method, target, version = parts
+                    body = await reader.readexactly(length)
+                    status, payload = await self.dispatch(method, urlsplit(target).path, body)
+                    keep = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+
+                data = json.dumps(payload).encode()
+                head = [f"HTTP/1.1 {status} {REASONS[status]}", "Content-Type: application/json",
+                        f"Content-Length: {len(data)}"]
+                if not keep:
+                    head.append("Connection: close")
+                writer.write("\r\n".join(head).encode() + b"\r\n\r\n" + data)
+                await writer.drain()
+                if not keep:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+async def serve(service, host="127.0.0.1", port=8765, unix=None):
+    """Accept connections on a TCP port, or a Unix socket path, until cancelled"""
+    if unix:
+        server = await asyncio.start_unix_server(service.handle, path=unix)
+        where = unix
+    else:
+        server = await asyncio.start_server(service.handle, host, port)
+        where = "http://%s:%d" % server.sockets[0].getsockname()[:2]
+    print(f"serving on {where} with {len(service.emulators)} emulators", file=sys.stderr)
+    # emulator threads print concurrently; each request collects only its own output
+    with contextlib.redirect_stdout(ThreadOutput(sys.stdout)):
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve emulator runs over local HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", metavar="PATH", help="listen on a Unix socket instead of TCP")
+    parser.add_argument("--pool", type=int, default=POOL_SIZE, help="warm emulators, i.e. concurrent runs")
+    parser.add_argument("--queue", type=int, default=MAX_QUEUE, help="requests allowed to wait for one")
+    parser.add_argument("--max-cycles", type=int, default=MAX_CYCLES)
+    parser.add_argument("--indexed", action="store_true", help="GPUs use indexed palette VRAM")
+    args = parser.parse_args(argv)
+
+    service = Service(args.pool, args.queue, args.max_cycles, indexed=args.indexed)
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import bisect
+
+import numpy as np
+
+CHUNK_SIZE = 4096  # bytes of VRAM per copy-on-write chunk
+
+
+class Snapshot:
+    """Frozen CPU/GPU machine state.
+
+    VRAM is kept as a tuple of immutable chunks; chunks that did not change
+    since the previous snapshot are the very same bytes objects, so a
+    snapshot of a mostly static frame costs little more than the tuple.
+    """
+
+    __slots__ = ("cycles", "cpu_registers", "memory", "gpu_registers", "vram_chunks")
+
+    def __init__(self, cycles, cpu_registers, memory, gpu_registers=None, vram_chunks=None):
+        self.cycles = cycles
+        self.cpu_registers = cpu_registers
+        self.memory = memory
+        self.gpu_registers = gpu_registers
+        self.vram_chunks = vram_chunks
+
+
+class Recorder:
+    """Checkpoints a CPU (and optionally a GPU) and rewinds by re-execution.
+
+    The CPU must provide resume(max_cycles) and a cycles counter, as
+    archi.DecodedCPU and archi.JITCPU do. run() takes a snapshot every
+    interval cycles; rewind(n) restores the newest snapshot at or before
+    the target cycle and deterministically re-executes the remainder.
+    """
+
+    def __init__(self, cpu, gpu=None, interval=1000, chunk_size=CHUNK_SIZE):
+        self.cpu = cpu
+        self.gpu = gpu
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.snapshots = []  # periodic snapshots, ordered by cycle
+        self._last_vram = None
+        self._last_chunks = None
+
+    def _vram_chunks(self):
+        """Chunk VRAM, reusing the previous snapshot's chunk objects where unchanged"""
+        flat = self.gpu.vram.reshape(-1)
+        starts = range(0, flat.size, self.chunk_size)
+        last = self._last_vram
+        if last is None or last.shape != flat.shape:
+            chunks = tuple(flat[i:i + self.chunk_size].tobytes() for i in starts)
+        else:
+            padded = -flat.size % self.chunk_size
+            diff = np.concatenate([flat != last, np.zeros(padded, dtype=bool)])
+            changed = diff.reshape(-1, self.chunk_size).any(axis=1)
+            chunks = tuple(
+                flat[i:i + self.chunk_size].tobytes() if changed[n] else self._last_chunks[n]
+                for n, i in enumerate(starts)
+            )
+        self._last_vram = flat.copy()
+        self._last_chunks = chunks
+        return chunks
+
+    def snapshot(self):
+        """Capture the current machine state"""
+        cpu = self.cpu
+        snap = Snapshot(
+            getattr(cpu, "cycles", 0),
+            (cpu.A, cpu.B, cpu.PC, cpu.zero_flag, cpu.carry_flag, cpu.running),
+            bytes(cpu.memory),
+        )
+        gpu = self.gpu
+        if gpu is not None:
+            snap.gpu_registers = (gpu.PC, gpu.program, gpu.running,
+                                  gpu.current_x, gpu.current_y,
+                                  gpu.current_r, gpu.current_g, gpu.current_b,
+                                  gpu.palette.tobytes(), dict(gpu.palette_index),
+                                  bytes(gpu.palette_used))
+            snap.vram_chunks = self._vram_chunks()
+        return snap
+
+    def restore(self, snap):
+        """Put the machine back into the state captured by snap"""
+        cpu = self.cpu
+        (cpu.A, cpu.B, cpu.PC, cpu.zero_flag, cpu.carry_flag, cpu.running) = snap.cpu_registers
+        cpu.memory[:] = snap.memory
+        cpu.invalidate()
+        if hasattr(cpu, "cycles"):
+            cpu.cycles = snap.cycles
+
+        gpu = self.gpu
+        if gpu is not None and snap.vram_chunks is not None:
+            (gpu.PC, gpu.program, gpu.running,
+             gpu.current_x, gpu.current_y,
+             gpu.current_r, gpu.current_g, gpu.current_b,
+             palette, palette_index, palette_used) = snap.gpu_registers
+            gpu.palette[:] = np.frombuffer(palette, dtype=np.uint8).reshape(gpu.palette.shape)
+            gpu.palette_index = dict(palette_index)
+            gpu.palette_used = bytearray(palette_used)
+            flat = np.frombuffer(b"".join(snap.vram_chunks), dtype=np.uint8)
+            gpu.vram.reshape(-1)[:] = flat
+            gpu.mark_dirty(0, 0, gpu.width, gpu.height)
+            self._last_vram = flat.copy()
+            self._last_chunks = snap.vram_chunks
+
+    def checkpoint(self):
+        """Take a snapshot and keep it in the periodic history"""
+        snap = self.snapshot()
+        if self.snapshots and self.snapshots[-1].cycles == snap.cycles:
+            self.snapshots[-1] = snap
+        else:
+            self.snapshots.append(snap)
+        return snap
+
+    def run(self, max_cycles=None):
+        """Run the CPU from its current PC, checkpointing every interval cycles.
+
+        Returns the number of cycles executed.
+        """
+        cpu = self.cpu
+        executed = 0
+        cpu.running = True  # before the first checkpoint, so rewinding to it resumes a running CPU
+        if not self.snapshots:
+            self.checkpoint()
+        while cpu.running and (max_cycles is None or executed < max_cycles):
+            budget = self.interval - cpu.cycles % self.interval
+            if max_cycles is not None:
+                budget = min(budget, max_cycles - executed)
+            executed += cpu.resume(budget)
+            if cpu.cycles % self.interval == 0:
+                self.checkpoint()
+        return executed
+
+    def rewind(self, n_cycles):
+        """Step the machine back n_cycles, returning the cycle count reached"""
+        target = max(self.cpu.cycles - n_cycles, 0)
+        cycles = [snap.cycles for snap in self.snapshots]
+        index = bisect.bisect_right(cycles, target) - 1
+        if index < 0:
+            raise ValueError(f"No snapshot at or before cycle {target}")
+
+        # Later snapshots would be re-created identically by running again
+        del self.snapshots[index + 1:]
+        self.restore(self.snapshots[index])
+        remaining = target - self.cpu.cycles
+        if remaining:
+            self.cpu.resume(remaining)
+        return self.cpu.cycles
+
+    def stored_bytes(self):
+        """Bytes held by the history, counting shared VRAM chunks once"""
+        seen = set()
+        total = 0
+        for snap in self.snapshots:
+            total += len(snap.memory)
+            for chunk in snap.vram_chunks or ():
+                if id(chunk) not in seen:
+                    seen.add(id(chunk))
+                    total += len(chunk)
+        return total